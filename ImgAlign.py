@@ -5,20 +5,30 @@ import glob
 import numpy as np
 import argparse
 import math
+import time
 import traceback
-import wand.image
-from scipy import ndimage
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import vapoursynth as vs
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import functools
-from wand.image import Image
+import hashlib
+import json
+import threading
+import contextlib
+import signal
+from collections import deque
 
 parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument("-s", "--scale", help="Positive integer value.  How many times bigger you want the HR resolution to be from the LR\nresolution.", required=True)
+parser.add_argument("-s", "--scale", help="Positive integer value.  How many times bigger you want the HR resolution to be from the LR\nresolution.  Several scales separated by commas, like 2,3,4, align each pair once and save every\nscale to its own Output/x<scale> folder with the same crop.", required=True)
 parser.add_argument("-m", "--mode", required=True, help="Options: 0 or 1.  Mode 0 manipulates the HR images while remaining true to the LR images aside\nfrom cropping.  Mode 1 manipulates the LR images and remains true to the HR images aside from\ncropping.")
 parser.add_argument("-c", "--autocrop", action='store_true', default=False, help="Disabled by default.  If enabled, this auto crops black boarders around HR and LR images.")
 parser.add_argument("-t", "--threshold", default=50, help="Integer 0-255, default 50.  Luminance threshold for autocropping.  Higher values cause more\nagressive cropping.")
-parser.add_argument("-n", "--threads", default=1, help="Default 1.  Number of threads to use for automatic matching.  Large images require a lot of RAM,\nso start small to test first.")
+parser.add_argument("-n", "--threads", default=1, help="Default 1.  Number of worker processes to use for automatic matching.  Large images require a lot\nof RAM, so start small to test first or set a memory budget with -b.")
+parser.add_argument("--decoders", default=2, help="Default 2.  Number of threads decoding image pairs ahead of the alignment.")
+parser.add_argument("--encoders", default=2, help="Default 2.  Number of threads encoding and saving output images while the next pairs align.")
+parser.add_argument("--format", default='png', choices=['png', 'webp', 'npy'], help="Default png.  Output image format.  webp is saved lossless, npy saves the raw arrays with no\nencoding cost.")
+parser.add_argument("--compression", default=None, help="Default is the OpenCV default.  PNG compression level 0-9.  Lower levels save faster but make\nlarger files.")
+parser.add_argument("--tile", default=2048, help="Default 2048.  Output images are warped in tiles of this many pixels per side, each reading\nonly the part of the source it maps from, so very large images align in bounded memory.  Output\nis identical for any tile size.  0 warps the whole image at once.")
+parser.add_argument("-b", "--memory", default=0, help="Default 0 (no limit).  Memory budget in MB shared by all worker processes.  New pairs are only\nstarted while the estimated memory of the pairs in flight fits in the budget.")
 parser.add_argument("-r", "--rotate", action='store_true', default=False, help="Disabled by default.  If enabled, this allows rotations when aligning images.")
 parser.add_argument("-g", "--hr", default='', help="HR File or folder directory.  No need to use if they are in HR folder in current working\ndirectory.")
 parser.add_argument("-l", "--lr", default='', help="LR File or folder directory.  No need to use if they are in LR folder in current working\ndirectory.")
@@ -26,104 +36,417 @@ parser.add_argument("-o", "--overlay", action='store_false', default=True, help=
 parser.add_argument("-f", "--full", action='store_true', default=False, help="Disabled by default.  If enabled, this allows full homography mapping of the image, correcting\nrotations, translations, and warping.")
 parser.add_argument("-e", "--score", action='store_true', default=False, help="Disabled by default.  Calculate an alignment score for each processed pair of images")
 parser.add_argument("-w", "--warp", action='store_true', default=False, help="Disabled by default.  Match images using Thin Plate Splines, allowing full image warping")
+parser.add_argument("-p", "--pyramid", action='store_true', default=False, help="Disabled by default.  Coarse to fine matching.  Estimates the transform on downscaled copies,\nthen refines it on full resolution tiles.  Much faster and lighter on large images.")
+parser.add_argument("--phase", action='store_false', default=True, help="Enabled by default.  Without -r, -f or -w, first estimate scale and translation by phase\ncorrelation, log-polar for the scale, and refine it on full size tiles.  Feature matching is only\nrun when the tiles disagree or a small feature check doesn't confirm it.  Pass to always match features.")
+parser.add_argument("-k", "--matcher", default='bf', choices=['bf', 'flann', 'block'], help="Default bf.  Feature matcher.  bf is OpenCV brute force, flann is an approximate KD-tree\nsearch that scales to many more features, block is an exact NumPy matcher working in blocks.")
+parser.add_argument("-x", "--features", default=500, help="Default 500.  Maximum number of SIFT features detected per image, 0 for no limit.  More\nfeatures give more robust fits on detailed images, use with -k flann.")
+parser.add_argument("-z", "--ratio", default=0.7, help="Default 0.7.  Ratio test threshold for feature matches.  Lower values keep fewer, more\ndistinctive matches.")
+parser.add_argument("-j", "--cache", default='', help="Disabled by default.  Folder for a persistent cache of SIFT features keyed by image content and\npreprocessing settings.  Repeat runs over the same images skip feature detection.")
+parser.add_argument("-y", "--cachesize", default=10240, help="Default 10240.  Size limit of the feature cache in MB.  Least recently used entries are removed\nwhen it fills up.")
+parser.add_argument("-d", "--resume", action='store_true', default=False, help="Disabled by default.  Resume a folder run.  Pairs recorded as done in Output/Manifest.jsonl\nwith unchanged input files and settings are skipped, new, modified and failed pairs are processed.")
+parser.add_argument("-v", "--video", action='store_true', default=False, help="Disabled by default.  Video mode.  -g and -l are two encodes of the same video with the same\nframe rate, read through VapourSynth (needs the L-SMASH Works or FFMS2 plugin).  Sampled frames\nare aligned straight from the decoder and saved as <video name>_<HR frame number>.")
+parser.add_argument("--every", default=24, help="Default 24.  Video mode, align every Nth frame.  With --scenes, the minimum number of frames\nbetween samples.")
+parser.add_argument("--scenes", action='store_true', default=False, help="Disabled by default.  Video mode, align one frame from every scene instead of every Nth frame.")
+parser.add_argument("--sync", default=0, help="Default 0.  Video mode, search up to this many frames either way for the LR frame offset that\nsyncs the clips.  0 assumes they are already in sync.")
+parser.add_argument("-q", "--sequence", action='store_true', default=False, help="Disabled by default.  Sequence mode for consecutive video frames.  Pairs are processed in name\norder and each reuses the previous transform when a quick phase correlation check confirms it,\nfalling back to full matching after scene cuts.  Reused transforms are smoothed over the sequence.")
+parser.add_argument("--export", action='store_true', default=False, help="Disabled by default.  Save the transform, crop and autocrop bounds of every pair to\nOutput/Transforms/<name>.json so the pairs can be rendered again with --apply.")
+parser.add_argument("--apply", default='', help="Folder of transforms saved with --export.  Renders the -g and -l folders from the saved\ntransforms without any matching, for example with another --interp filter or for masks, depth\nmaps or other grades of the same images.  Images are read with all channels and bit depth.")
+parser.add_argument("--interp", default='lanczos', choices=['nearest', 'linear', 'cubic', 'area', 'lanczos'], help="Default lanczos.  Interpolation used when rendering with --apply.")
+parser.add_argument("--pair", action='store_true', default=False, help="Disabled by default.  Pair HR and LR images by content instead of file name.  Each HR image\nis paired with the LR image whose thumbnail is most alike, and the candidates and confidence of\nevery pairing are written to Output/Pairing.jsonl.  Outputs are named after the HR images.")
+parser.add_argument("--review", type=float, nargs='?', const=0.5, default=None, metavar='SCORE', help="Disabled by default.  Review mode.  Aligns the folders automatically with every thread, then\nopens the manual point selection windows only for pairs that failed or scored under SCORE, 0.5\nwhen not given, worst first.  The windows start with points from the automatic matching.\nCorrections are saved to Output/Reviewed/<name>.json and the pair is rendered again.")
+parser.add_argument("--watch", action='store_true', default=False, help="Disabled by default.  Watch mode.  Keeps running and aligns new pairs as they appear in the -g and\n-l folders, once both files have stopped changing.  The worker pool stays warm between pairs.  Queue\ndepth and throughput are kept in Output/Status.json.  Stop with Ctrl+C.")
+parser.add_argument("--interval", default=5, help="Default 5.  Watch mode, seconds between folder scans.  Scans also run early on file system\nevents when the watchdog package is installed, checking only the pairs the events name.")
+parser.add_argument("--profile", default='', help="Disabled by default.  File to record the wall time and peak memory of every stage of every\npair to, as JSON lines, or as a Chrome trace when the name ends in .json.  A p50/p95 summary of\nthe stages and the pairs per second are printed at the end of the run.")
 parser.add_argument("-u", "--manual", action='store_true', default=False, help="Disabled by default.  Manual mode.  If enabled, this opens windows for working pairs of images\nto be aligned.  Double click pairs of matching points on each image in sequence, and close the\nwindows when finished.\n\nManual Keys: \nDouble click left: Select point.\nClick and Drag left: Pan image.\nScroll Wheel: Zoom in and out.\nDouble Click right: Reset image view.\nu: Undo last point selection.\nw: Close both windows to progress.\np: Preview alignment.  Overlays images using current alignment points.")
 
 
-args = vars(parser.parse_args())
-
-scale = float(args["scale"])
-mode = int(args["mode"])
-autocrop = args["autocrop"]
-lumthresh = int(args["threshold"])
-threads = int(args["threads"])
-rotate = args["rotate"]
-HRfolder = args["hr"]
-LRfolder = args["lr"]
-Overlay = args["overlay"]
-Homography = args["full"]
-Manual = args["manual"]
-score = args["score"]
-warp = args["warp"]
-core = vs.core
-
-if warp or score:
-    from sklearn.linear_model import RANSACRegressor
-
-if warp:
-    Homography = False
-    Manual = True
+# Command line options by their long names with the defaults of any not given, required ones are None
+def default_options():
+    return {action.dest: action.default for action in parser._actions if action.dest != 'help'}
+
+# Set the module wide settings from a dict of options by their long names, as parsed from the command line
+# or given to an Aligner.  Runs again in every worker process of a run
+def configure(options):
+    global args, scale, scales, scale_folders, snap, mode, autocrop, lumthresh, threads, memory, decoders, encoders, output_format, TILE, \
+        compression, rotate, HRfolder, LRfolder, Overlay, Homography, Manual, score, warp, pyramid, phase, \
+        matcher, ratio, cachedir, cachesize, resume, video, every, scenes, sync, sequence, export, apply, \
+        profile, watch, pairing, review, interval, interp, MAX_FEATURES
+    args = dict(options)
+
+    values = args["scale"] if isinstance(args["scale"], (list, tuple)) else str(args["scale"]).split(',')
+    scales = [float(value) for value in values]
+    if len(scales) > 1 and any(value != int(value) for value in scales):
+        raise ValueError('Several scales must all be whole numbers')
+    scale = scales[0]
+    scale_folders = [''] if len(scales) == 1 else ['x{:g}/'.format(value) for value in scales]
+    mode = int(args["mode"])
+    autocrop = args["autocrop"]
+    lumthresh = int(args["threshold"])
+    threads = int(args["threads"])
+    memory = int(float(args["memory"])*1024**2)
+    decoders = max(1, int(args["decoders"]))
+    encoders = max(1, int(args["encoders"]))
+    output_format = args["format"]
+    TILE = int(args["tile"])
+    compression = None if args["compression"] is None else int(args["compression"])
+    rotate = args["rotate"]
+    HRfolder = args["hr"]
+    LRfolder = args["lr"]
+    Overlay = args["overlay"]
+    Homography = args["full"]
+    Manual = args["manual"]
+    score = args["score"]
+    warp = args["warp"]
+    pyramid = args["pyramid"]
+    phase = args["phase"]
+    matcher = args["matcher"]
+    ratio = float(args["ratio"])
+    cachedir = args["cache"]
+    cachesize = int(float(args["cachesize"])*1024**2)
+    resume = args["resume"]
+    video = args["video"]
+    every = max(1, int(args["every"]))
+    scenes = args["scenes"]
+    sync = int(args["sync"])
+    sequence = args["sequence"]
+    export = args["export"]
+    apply = args["apply"]
+    profile = args["profile"]
+    watch = args["watch"]
+    pairing = args["pair"]
+    review = args["review"]
+    interval = float(args["interval"])
+    interp = {'nearest': cv2.INTER_NEAREST, 'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC, 'area': cv2.INTER_AREA, 'lanczos': cv2.INTER_LANCZOS4}[args["interp"]]
+
+    if warp:
+        Homography = False
+        Manual = True
+
+    if sequence:
+        threads = 1
 
-if Manual:
-    import matplotlib.pyplot as plt
-    import matplotlib as mpl
-    from mpl_interactions import zoom_factory, panhandler
-    threads = 1
+    if Manual:
+        manual_ui()
+        threads = 1
+        review = None
 
-MAX_FEATURES = 500
+    if review is not None:
+        score = True
 
+    # Mode 1 crops are a whole number of LR pixels at every scale
+    snap = scale if len(scales) == 1 else math.lcm(*(int(value) for value in scales))
+    if mode == 1:
+        scale = 1/scale
+        scales = [1/value for value in scales]
 
-def get_vsFrame(n, f, npArray):
-    vsFrame = f.copy()
-    [np.copyto(np.asarray(vsFrame[i]), npArray[:, :, i]) for i in [2, 1, 0]]
-    return vsFrame
+    MAX_FEATURES = int(args["features"])
 
+# Import the plotting modules of manual point selection
+def manual_ui():
+    global plt, mpl, zoom_factory, panhandler
+    import matplotlib.pyplot as plt
+    import matplotlib as mpl
+    from mpl_interactions import zoom_factory, panhandler
 
+# Feature matching backend settings
+FLANN_TREES = 5
+FLANN_CHECKS = 64
+MATCH_BLOCK = 1024
+# Record of every pair processed in folder runs, one JSON object per line
+MANIFEST = 'Output/Manifest.jsonl'
+# Alignment score records, one JSON object per line
+SCORES = 'Output/AlignmentScore.jsonl'
+# Content pairing: thumbnail side of the image descriptors, candidates reported per HR image, the lowest
+# similarity that still pairs, the margin over the runner up below which a pairing is flagged as unsure,
+# and the saved descriptors reused for unchanged files
+PAIR_THUMB = 8
+PAIR_CANDIDATES = 3
+PAIR_SIMILARITY = 0.3
+PAIR_MARGIN = 0.1
+PAIR_INDEX = 'Output/PairIndex.npz'
+# Review mode: automatic points the manual windows start with
+REVIEW_SEEDS = 8
+# Watch mode status file, seconds both files of a pair have to stay unchanged before it is queued, the
+# seconds of recent pairs the throughput is measured over, and the seconds between full folder scans when file
+# system events say which pairs changed, catching any events that were missed
+STATUS = 'Output/Status.json'
+WATCH_SETTLE = 2
+WATCH_WINDOW = 300
+WATCH_RESCAN = 300
+# Video mode thumbnail size for syncing and scene detection, brightness change that counts as a scene cut,
+# frames to skip into a new scene past any transition, and the number of frames compared when syncing
+VIDEO_THUMB = 64
+SCENE_THRESHOLD = 0.1
+SCENE_SKIP = 5
+SYNC_WINDOW = 500
+# Phase correlation fast path: working size of the log-polar scale search, largest rotation in degrees it
+# may find, refinement tiles per side, their largest size, refinement passes, lowest response of a tile that
+# counts, largest RMS tile residual in image 2 pixels, and size and number of agreeing matches of the
+# feature check
+PHASE_SIZE = 512
+PHASE_ANGLE = 2
+PHASE_TILES = 3
+PHASE_TILE = 256
+PHASE_PASSES = 2
+PHASE_RESPONSE = 0.1
+PHASE_TOLERANCE = 0.5
+PHASE_CHECK = 384
+PHASE_CHECK_MATCHES = 8
+# Sequence mode tracking image size, lowest phase correlation response and largest shift in tracking pixels
+# that still confirm the previous transform, and the passes measuring the shift.  The weight of the previous
+# output transform when smoothing, and the largest difference from it in image 2 pixels that is smoothed,
+# about the noise of the tracked shift so drift is never lagged by more than half of it
+TRACK_SIZE = 512
+TRACK_RESPONSE = 0.1
+TRACK_SHIFT = 4
+TRACK_PASSES = 2
+SEQUENCE_SMOOTHING = 0.5
+SEQUENCE_JITTER = 0.05
+# Spacing in image 2 pixels of the grid thin plate splines are evaluated on
+TPS_GRID = 16
+# Source pixels read around each warp tile for the interpolation taps, enough for Lanczos4
+TILE_HALO = 5
+# Longest side of the downscaled mask the usable rectangle is searched on
+RECT_SIZE = 512
+# Longest side of the coarse pyramid level, number of refinement tiles per side, refinement tile size
+# in matching pixels, and how far in coarse pixels refined matches may stray from the coarse transform
+PYRAMID_SIZE = 1024
+PYRAMID_TILES = 3
+PYRAMID_TILE = 512
+PYRAMID_TOLERANCE = 3
+# Longest side the dense alignment metrics are computed at, tiles per side of the misalignment map, the
+# phase correlation response below which a tile has too little texture to count, and the residual shift in
+# LR pixels at which the score reaches 0
+SCORE_SIZE = 1024
+SCORE_TILES = 4
+SCORE_RESPONSE = 0.05
+SCORE_SHIFT = 2
+# Estimated number of full size working copies of each decoded image alive while aligning a pair
+WORKING_COPIES = 4
+
+
+# Stage events of the pair the current thread is working on, only collected when profiling
+profiling = threading.local()
+
+# Current and peak resident memory of this process in MB.  Current is read from /proc and is None where there
+# is none, peak is the high-water mark of the whole process so far and None where the platform doesn't report it
+def memory_usage():
+    current = peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak/2**20 if sys.platform == 'darwin' else peak/1024
+    except ImportError:
+        pass
+    return current, peak
+
+# How far resident memory rose between two memory_usage() readings, from the current memory, or from the
+# high-water mark where a stage pushed it up and freed the memory again before it ended
+def memory_rise(before, after):
+    rises = [end - start for start, end in zip(before, after) if start is not None and end is not None]
+    return max([0] + rises) if rises else None
+
+# Time one stage of the current pair, as a with block or a function decorator.  Time spent in stages nested
+# inside it is taken out of its own time, so the stages of a pair add up to the pair
+@contextlib.contextmanager
+def stage(name):
+    events = getattr(profiling, 'events', None)
+    if events is None:
+        yield
+        return
+    before = memory_usage()
+    start = time.perf_counter()
+    profiling.nested.append(0)
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        after = memory_usage()
+        inner = profiling.nested.pop()
+        if profiling.nested:
+            profiling.nested[-1] += end - start
+        events.append({'stage': name, 'start': start, 'end': end, 'self': end - start - inner, 'rss': after[0],
+                       'rise': memory_rise(before, after), 'peak': after[1], 'pid': os.getpid(), 'tid': threading.get_ident()})
+
+# Start collecting stage events on this thread, and hand them over when done
+def profile_begin():
+    if profile:
+        profiling.events, profiling.nested = [], []
+
+def profile_end():
+    events = getattr(profiling, 'events', None) or []
+    profiling.events = None
+    return events
+
+# Run a function as a single stage of its own, returns its result and the stage events
+def timed(name, function, *args):
+    profile_begin()
+    try:
+        with stage(name):
+            result = function(*args)
+    finally:
+        events = profile_end()
+    return result, events
+
+# Stage times of every pair of the run for the summary
+profile_times = {}
+profile_rises = {}
+profile_peak = None
+profile_pairs = 0
+profile_start = time.perf_counter()
+
+# Start the profile file of a run
+def profile_open():
+    global profile_start
+    profile_start = time.perf_counter()
+    with open(profile, 'w') as f:
+        if profile.endswith('.json'):
+            f.write('[\n')
+
+# Record the stage events of a finished pair, one JSON line per pair with the time, resident memory at the end
+# and memory rise of each stage and the peak memory of the process, or complete events of the Chrome trace format
+def profile_pair(name, events):
+    global profile_pairs, profile_peak
+    if not profile:
+        return
+    profile_pairs += 1
+    stages, peak = {}, None
+    for event in events:
+        entry = stages.setdefault(event['stage'], {'time': 0, 'rss': None, 'rise': None})
+        entry['time'] += event['self']
+        for field in ('rss', 'rise'):
+            if event[field] is not None:
+                entry[field] = round(max(entry[field] or 0, event[field]), 1)
+        if event['peak'] is not None:
+            peak = round(max(peak or 0, event['peak']), 1)
+    for key, entry in stages.items():
+        profile_times.setdefault(key, []).append(entry['time'])
+        if entry['rise'] is not None:
+            profile_rises[key] = max(profile_rises.get(key, 0), entry['rise'])
+    if peak is not None:
+        profile_peak = max(profile_peak or 0, peak)
+
+    with open(profile, 'a') as f:
+        if profile.endswith('.json'):
+            for event in events:
+                f.write(json.dumps({'name': event['stage'], 'cat': name, 'ph': 'X', 'ts': round((event['start'] - profile_start)*1e6),
+                                    'dur': round((event['end'] - event['start'])*1e6), 'pid': event['pid'], 'tid': event['tid'],
+                                    'args': {'pair': name, 'self': event['self'], 'rss': event['rss'], 'rise': event['rise']}}) +',\n')
+        else:
+            f.write(json.dumps({'name': name, 'peak': peak, 'stages': {key: {'time': round(entry['time'], 6), 'rss': entry['rss'], 'rise': entry['rise']}
+                                                                        for key, entry in stages.items()}}) +'\n')
+
+# Close the profile file and print the p50 and p95 time and largest memory rise of each stage per pair, the
+# pairs per second and the peak memory
+def profile_summary():
+    if not profile:
+        return
+    elapsed = time.perf_counter() - profile_start
+    if profile.endswith('.json'):
+        with open(profile, 'a') as f:
+            f.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': 'ImgAlign'}}) +'\n]\n')
+    print('{:<16s}{:>10s}{:>10s}{:>10s}{:>12s}'.format('Stage', 'p50', 'p95', 'Total', 'Rise MB'))
+    for key, times in sorted(profile_times.items(), key=lambda item: -sum(item[1])):
+        rise = '{:.0f}'.format(profile_rises[key]) if key in profile_rises else '-'
+        print('{:<16s}{:>9.3f}s{:>9.3f}s{:>9.2f}s{:>12s}'.format(key, np.percentile(times, 50), np.percentile(times, 95), sum(times), rise))
+    print('{:d} pairs in {:.2f}s, {:.2f} pairs/s'.format(profile_pairs, elapsed, profile_pairs/max(elapsed, 1e-9)))
+    if profile_peak is not None:
+        print('Peak memory {:.0f} MB'.format(profile_peak))
+
+# Mitchell-Netravali cubic kernel with B and C parameters
+def bicubic_kernel(x, b, c):
+    x = np.abs(x)
+    x2, x3 = x*x, x*x*x
+    near = ((12 - 9*b - 6*c)*x3 + (-18 + 12*b + 6*c)*x2 + (6 - 2*b))/6
+    far = ((-b - 6*c)*x3 + (6*b + 30*c)*x2 + (-12*b - 48*c)*x + (8*b + 24*c))/6
+    return np.where(x < 1, near, np.where(x < 2, far, 0))
+
+# Per-axis source indices and weights for a centre aligned resize, cached since batches reuse the same sizes
+@functools.lru_cache(maxsize=64)
+def bicubic_weights(src, dst, b, c):
+    ratio = src/dst
+    # Widen the kernel when downscaling so it also acts as the low pass filter
+    stretch = max(ratio, 1)
+    support = 2*stretch
+    taps = int(math.ceil(support))*2
+    centre = (np.arange(dst) + 0.5)*ratio - 0.5
+    first = np.floor(centre - support).astype(np.int64) + 1
+    index = first[:, None] + np.arange(taps)[None, :]
+    weights = bicubic_kernel((index - centre[:, None])/stretch, b, c)
+    weights /= weights.sum(1, keepdims=True)
+
+    # Mirror taps that fall outside the image back onto the edge pixels
+    index = np.where(index < 0, -index - 1, index)
+    index = np.where(index > src - 1, 2*src - 1 - index, index)
+    index = np.clip(index, 0, src - 1)
+    return index, weights.astype(np.float32)
+
+def bicubic_axis(image, new_len, axis, b, c):
+    if image.shape[axis] == new_len:
+        return image
+    index, weights = bicubic_weights(image.shape[axis], new_len, b, c)
+    image = np.moveaxis(image, axis, 0)
+    shape = (-1,) + (1,)*(image.ndim - 1)
+    out = np.zeros((new_len,) + image.shape[1:], np.float32)
+    for tap in range(index.shape[1]):
+        out += weights[:, tap].reshape(shape)*image[index[:, tap]]
+    return np.moveaxis(out, 0, axis)
+
+# Separable bicubic resize matching VapourSynth's resize.Bicubic with filter_param_a=b and filter_param_b=c
+@stage('resize')
 def bicubic_resize_bc(image, new_size, b=1/3, c=1/3):
-    height, width, channels = image.shape
+    height, width = image.shape[:2]
     new_width, new_height = new_size
-    numpy_array = image.transpose(2, 0, 1).flatten().tobytes()
-    clip = core.std.BlankClip(width=width, height=height, length=1)
-
-    clip = core.std.ModifyFrame(
-        clip=clip,
-        clips=clip,
-        selector=functools.partial(get_vsFrame, npArray=cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-    )
-
-    # Perform custom bicubic resize using VapourSynth
-    # clip = clip.resize.Bicubic(width=new_width*2, height=new_height*2)
-    # clip = clip.resize.Bicubic(width=new_width, height=new_height, filter_param_a=b, filter_param_b=c)
-    # clip = clip.resize.Bicubic(width=new_width*2, height=new_height*2, filter_param_a=1, filter_param_b=0)
-    clip = clip.resize.Bicubic(width=new_width, height=new_height, filter_param_a=b, filter_param_b=c)
+    if (new_width, new_height) == (width, height):
+        return image
+    dtype = image.dtype
+    # The first pass reads the source directly, the taps promote it to float32
+    out = image
+
+    # Run the pass that shrinks the image most first so the second pass has less to do
+    if new_height*width < height*new_width:
+        out = bicubic_axis(out, new_height, 0, b, c)
+        out = bicubic_axis(out, new_width, 1, b, c)
+    else:
+        out = bicubic_axis(out, new_width, 1, b, c)
+        out = bicubic_axis(out, new_height, 0, b, c)
 
-    # Convert the resized VideoNode back to an image
-    frame = clip.get_frame(0)
-    planes_count = frame.format.num_planes
-    return cv2.merge([np.array(frame[i], copy=True) for i in reversed(range(planes_count))])
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        out = np.clip(np.rint(out), info.min, info.max)
+    return out.astype(dtype)
 
 
-def AutoCrop(image):
+def AutoCrop(image, bounds=None):
     """Crops any edges below or equal to threshold
     Crops blank image to 1x1.
     Returns cropped image.
+    Appends the [top, bottom, left, right] slice bounds to bounds when given.
     """
     threshold = lumthresh
-    if len(image.shape) == 3:
-        flatImage = np.max(image, 2)
-    else:
-        flatImage = image
-    assert len(flatImage.shape) == 2
+    assert image.ndim in (2, 3)
 
-    rows = np.where(np.max(flatImage, 0) > threshold)[0]
+    # Maxima of every column and row straight from the image, without a full size flattened copy
+    rows = np.where(image.max(axis=(0, 2) if image.ndim == 3 else 0) > threshold)[0]
     if rows.size:
-        cols = np.where(np.max(flatImage, 1) > threshold)[0]
-        image = image[cols[0]: cols[-1] + 1, rows[0]: rows[-1] + 1]
+        cols = np.where(image.max(axis=(1, 2) if image.ndim == 3 else 1) > threshold)[0]
+        crop = [int(cols[0]), int(cols[-1]) + 1, int(rows[0]), int(rows[-1]) + 1]
     else:
-        image = image[:1, :1]
+        crop = [0, 1, 0, 1]
+    image = image[crop[0]:crop[1], crop[2]:crop[3]]
+    if bounds is not None:
+        bounds.append(crop)
 
     return image
 
-# Remove outliers from points
-def ransac(pnt1, pnt2):
-    pnt1x, pnt1y = pnt1.reshape(-1,2)[:,0].reshape(-1,1), pnt1.reshape(-1,2)[:,1].reshape(-1,1)
-    pnt2x, pnt2y = pnt2.reshape(-1,2)[:,0].reshape(-1,1), pnt2.reshape(-1,2)[:,1].reshape(-1,1)
-    ransacx = RANSACRegressor().fit(pnt1x, pnt2x)
-    ransacy = RANSACRegressor().fit(pnt1y, pnt2y)
-    inlier_maskx = ransacx.inlier_mask_
-    inlier_masky = ransacy.inlier_mask_
-    inliers = inlier_maskx*inlier_masky
-    pnt1, pnt2 = pnt1[inliers], pnt2[inliers]
-    return pnt1, pnt2
+# Grayscale of a BGR image, or the image itself when it already is one
+def grayscale(image):
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
 # Create and apply Thin Plate Spline transform to an image
 def WarpImage_TPS(source, target, img, interp):
@@ -138,15 +461,12 @@ def WarpImage_TPS(source, target, img, interp):
         matches.append(cv2.DMatch(i,i,0))
 
     tps.estimateTransformation(target, source, matches)
-    if interp == 0:
-        new_img = tps.warpImage(img, flags = cv2.INTER_NEAREST)
-    else:
-        new_img = tps.warpImage(img, flags = cv2.INTER_LANCZOS4)
+    new_img = tps.warpImage(img, flags = interp)
 
     return new_img
 
-# Make and manipulate plots for manual point selection 
-def manual_points(img1, img2):
+# Make and manipulate plots for manual point selection, starting from seed points when given
+def manual_points(img1, img2, seeds=None):
     global pnts1, pnts2, markers1, markers2, active
 
     pnts1 = np.array([])
@@ -156,6 +476,11 @@ def manual_points(img1, img2):
     markers1 = []
     markers2 = []
     active = []
+    if seeds is not None:
+        pnts1 = seeds[0].reshape(-1,2).astype(np.float64)
+        pnts2 = seeds[1].reshape(-1,2).astype(np.float64)
+        active = [1, 2]*len(pnts1)
+        print('Starting from {:d} automatic points, u removes the last one'.format(len(pnts1)))
 
     # Matplotlib UI functions
     def onclick(event, graph):
@@ -223,14 +548,14 @@ def manual_points(img1, img2):
                     temp1 = cv2.warpPerspective(img1, hom, (img2.shape[1],img2.shape[0]), flags = cv2.INTER_LANCZOS4)
                 elif warp:
                     temp1 = np.pad(img1,[(0,max(0,img2.shape[0]-img1.shape[0])),(0,max(0,img2.shape[1]-img1.shape[1])),(0,0)])
-                    temp1 = WarpImage_TPS(pnts1, pnts2, temp1, 1)
+                    temp1 = WarpImage_TPS(pnts1, pnts2, temp1, cv2.INTER_LANCZOS4)
                     temp1 = temp1[0:img2.shape[0],0:img2.shape[1],:]
                 else:
                     hom, _ = cv2.estimateAffine2D(pnts1, pnts2, cv2.RANSAC)
                     if not rotate:
-                        sx = math.sqrt(h[0,0]**2+h[1,0]**2)
-                        sy = math.sqrt(h[0,1]**2+h[1,1]**2)
-                        h[:,:2] = np.array([[sx,0],[0,sy]])
+                        sx = math.sqrt(hom[0,0]**2+hom[1,0]**2)
+                        sy = math.sqrt(hom[0,1]**2+hom[1,1]**2)
+                        hom[:,:2] = np.array([[sx,0],[0,sy]])
                     temp1 = cv2.warpAffine(img1, hom, (img2.shape[1],img2.shape[0]), flags = cv2.INTER_LANCZOS4)
                 preview = cv2.addWeighted(temp1,0.5,img2,0.5,0)
                 with plt.ioff():
@@ -246,9 +571,12 @@ def manual_points(img1, img2):
                 plt.tight_layout()
                 plt.show()
 
-    # Generate the plots and link functions and controls
+    # Generate the plots and link functions and controls.  The windows open at least once, also when seed
+    # points alone would be enough
     preview = img2[:]
-    while len(pnts1) < 4 or (len(pnts1) != len(pnts2)):
+    shown = False
+    while not shown or len(pnts1) < 4 or (len(pnts1) != len(pnts2)):
+        shown = True
         with plt.ioff():
             fig1, ax1 = plt.subplots()
         fig1.subplots_adjust(left=0,bottom=0,right=1,top=1)
@@ -295,157 +623,869 @@ def manual_points(img1, img2):
             print('At least 4 points must be selected and the same number of points must be on each image.')
     return pnts1, pnts2
 
-# Automatic point finding with SIFT
-def auto_points(im1, im2):
-
-    im1y, im1x, _ = im1.shape
-    im2y, im2x, _ = im2.shape
-
-    # im1 = cv2.resize(im1,(max(im1x,im2x),max(im1y,im2y)),interpolation=cv2.INTER_LANCZOS4)
-    im1 = bicubic_resize_bc(im1, (max(im1x,im2x),max(im1y,im2y)))
-    # im2 = cv2.resize(im2,(max(im1x,im2x),max(im1y,im2y)),interpolation=cv2.INTER_LANCZOS4)
-    im2 = bicubic_resize_bc(im2, (max(im1x,im2x),max(im1y,im2y)))
+# Matcher objects are built once per process and reused for every pair
+@functools.lru_cache(maxsize=None)
+def get_matcher(name):
+    if name == 'flann':
+        return cv2.FlannBasedMatcher(dict(algorithm=1, trees=FLANN_TREES), dict(checks=FLANN_CHECKS))
+    return cv2.BFMatcher(cv2.NORM_L2, crossCheck=False)
+
+# Exact two nearest neighbours computed a block of query descriptors at a time
+def block_knn(descriptors1, descriptors2):
+    norms1 = np.einsum('ij,ij->i', descriptors1, descriptors1)
+    norms2 = np.einsum('ij,ij->i', descriptors2, descriptors2)
+    nearest = np.empty((len(descriptors1),2), np.int64)
+    distances = np.empty((len(descriptors1),2), np.float32)
+    for start in range(0, len(descriptors1), MATCH_BLOCK):
+        block = slice(start, start+MATCH_BLOCK)
+        dist = norms1[block,None] + norms2[None,:] - 2*(descriptors1[block] @ descriptors2.T)
+        two = np.argpartition(dist, 1, axis=1)[:,:2]
+        twodist = np.take_along_axis(dist, two, 1)
+        order = np.argsort(twodist, 1)
+        nearest[block] = np.take_along_axis(two, order, 1)
+        distances[block] = np.sqrt(np.maximum(np.take_along_axis(twodist, order, 1), 0))
+    return nearest, distances
+
+# Match descriptors with the selected backend, returns query and train indices that pass the ratio test
+@stage('match')
+def match_descriptors(descriptors1, descriptors2):
+    if matcher == 'block':
+        nearest, distances = block_knn(descriptors1, descriptors2)
+        query, train = np.arange(len(descriptors1)), nearest[:,0]
+    else:
+        matches = [pair for pair in get_matcher(matcher).knnMatch(descriptors1,descriptors2,k=2) if len(pair) == 2]
+        query = np.int64([m.queryIdx for m, n in matches])
+        train = np.int64([m.trainIdx for m, n in matches])
+        distances = np.float32([[m.distance, n.distance] for m, n in matches]).reshape(-1,2)
+
+    good = distances[:,0] < ratio*distances[:,1]
+    return query[good], train[good]
+
+# Persistent feature cache.  Each entry is one .npy file holding keypoint positions and descriptors side
+# by side, sharded by key hash, with file modification times as the LRU order
+cache_bytes = None
+
+def cache_path(key):
+    name = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return os.path.join(cachedir, name[:2], name+'.npy')
+
+# Path and stat of every entry, skipping entries another process evicts while they are listed
+def cache_entries():
+    for shard in os.scandir(cachedir):
+        if shard.is_dir():
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.npy'):
+                    try:
+                        yield entry.path, entry.stat()
+                    except OSError:
+                        pass
+
+def cache_load(key):
+    path = cache_path(key)
+    try:
+        entry = np.load(path, mmap_mode='r')
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return np.array(entry[:,:2]), np.array(entry[:,2:])
+
+def cache_store(key, points, descriptors):
+    global cache_bytes
+    path = cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = '{:s}.{:d}.tmp'.format(path, os.getpid())
+    with open(temp, 'wb') as f:
+        np.save(f, np.hstack([points, descriptors]).astype(np.float32))
+        size = f.tell()
+    os.replace(temp, path)
+
+    if cache_bytes is None:
+        cache_bytes = sum(stat.st_size for _, stat in cache_entries())
+    else:
+        cache_bytes += size
+    if cache_bytes > cachesize:
+        cache_evict()
+
+# Remove least recently used entries until the cache is back under 90% of its size limit
+def cache_evict():
+    global cache_bytes
+    entries = sorted((stat.st_mtime, stat.st_size, path) for path, stat in cache_entries())
+    cache_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if cache_bytes <= 0.9*cachesize:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        cache_bytes -= size
+
+# Cache key of an image file from its content and the preprocessing applied before matching
+def image_key(path, prep=''):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return '{:s}:{:d}:{:d}:{:s}'.format(digest.hexdigest(), autocrop, lumthresh if autocrop else 0, prep)
+
+# SIFT detectors are built once per process for each feature count and reused for every pair
+@functools.lru_cache(maxsize=None)
+def get_detector(features):
+    return cv2.SIFT_create(features)
+
+# SIFT keypoint positions and descriptors of a gray image, or of a function returning it so cache hits
+# skip building the image.  Read from and written to the feature cache when a key is given
+@stage('detect')
+def detect(gray, key=None):
+    if key is not None:
+        key = '{:s}:{:d}'.format(key, MAX_FEATURES)
+        cached = cache_load(key)
+        if cached is not None:
+            return cached
+
+    if callable(gray):
+        gray = gray()
+    keypoints, descriptors = get_detector(MAX_FEATURES).detectAndCompute(gray, None)
+    points = np.float32([ k.pt for k in keypoints ]).reshape(-1,2)
+    if descriptors is None:
+        descriptors = np.zeros((0,128), np.float32)
+
+    if key is not None:
+        cache_store(key, points, descriptors)
+    return points, descriptors
+
+# Detect SIFT features on two gray images and return the matching points that pass the ratio test
+def sift_match(im1Gray, im2Gray, key1=None, key2=None):
+    points1, descriptors1 = detect(im1Gray, key1)
+    points2, descriptors2 = detect(im2Gray, key2)
+    if len(points1) == 0 or len(points2) < 2:
+        return np.zeros((0,2), np.float32), np.zeros((0,2), np.float32)
+
+    query, train = match_descriptors(descriptors1, descriptors2)
+    return points1[query], points2[train]
+
+# Feature cache keys of both images for one matching level, None when the cache is off
+def level_keys(info, level):
+    if not cachedir or info is None or 'keys' not in info:
+        return None, None
+    return tuple(key+':'+level for key in info['keys'])
 
-    im1Gray = cv2.cvtColor(im1, cv2.COLOR_BGR2GRAY)
-    im2Gray = cv2.cvtColor(im2, cv2.COLOR_BGR2GRAY)
+# Automatic point finding with SIFT
+def auto_points(im1, im2, info=None):
 
-    sift = cv2.SIFT_create(MAX_FEATURES)
-    keypoints1, descriptors1 = sift.detectAndCompute(im1Gray, None)
-    keypoints2, descriptors2 = sift.detectAndCompute(im2Gray, None)
+    if pyramid:
+        return pyramid_points(im1, im2, info)
 
-    bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=False)
-    matches = bf.knnMatch(descriptors1,descriptors2,k=2)
+    im1y, im1x = im1.shape[:2]
+    im2y, im2x = im2.shape[:2]
+    canvas = (max(im1x,im2x),max(im1y,im2y))
 
-    good = []
-    for m,n in matches:
-        if m.distance < 0.7*n.distance:
-            good.append(m)
+    # im1 = cv2.resize(im1,canvas,interpolation=cv2.INTER_LANCZOS4)
+    im1Gray = lambda: bicubic_resize_bc(grayscale(im1), canvas)
+    # im2 = cv2.resize(im2,canvas,interpolation=cv2.INTER_LANCZOS4)
+    im2Gray = lambda: bicubic_resize_bc(grayscale(im2), canvas)
 
-    if len(good) > 5:#5
-        points1 = np.float32([ keypoints1[m.queryIdx].pt for m in good ]).reshape(-1,1,2)
-        points2 = np.float32([ keypoints2[m.trainIdx].pt for m in good ]).reshape(-1,1,2)
+    points1, points2 = sift_match(im1Gray, im2Gray, *level_keys(info, 'full:{:d}x{:d}'.format(*canvas)))
+    if len(points1) <= 5:#5
+        raise ValueError('Not enough matching points found')
+    points1, points2 = points1.reshape(-1,1,2), points2.reshape(-1,1,2)
 
     points1[:,0,0], points1[:,0,1] = points1[:,0,0]*im1x/max(im1x,im2x), points1[:,0,1]*im1y/max(im1y,im2y)
     points2[:,0,0], points2[:,0,1] = points2[:,0,0]*im2x/max(im1x,im2x), points2[:,0,1]*im2y/max(im1y,im2y)
 
     return points1, points2
 
-# Find a large usable rectangle from a transformed dummy array
+# Seed points for a review session, RANSAC inliers of the automatic matches spread over image 1 by taking the
+# farthest from those already chosen.  None when the automatic matching finds nothing
+def review_seeds(im1, im2, info=None):
+    try:
+        points1, points2 = auto_points(im1, im2, info)
+    except Exception:
+        return None
+    if Homography:
+        _, inliers = cv2.findHomography(points1, points2, cv2.RANSAC)
+    else:
+        _, inliers = cv2.estimateAffine2D(points1, points2, cv2.RANSAC)
+    if inliers is None or not inliers.any():
+        return None
+    keep = inliers.ravel().astype(bool)
+    points1, points2 = points1.reshape(-1,2)[keep], points2.reshape(-1,2)[keep]
+
+    chosen = [0]
+    distance = np.linalg.norm(points1 - points1[0], axis=1)
+    while len(chosen) < min(REVIEW_SEEDS, len(points1)):
+        chosen.append(int(distance.argmax()))
+        distance = np.minimum(distance, np.linalg.norm(points1 - points1[chosen[-1]], axis=1))
+    return points1[chosen], points2[chosen]
+
+# Coarse to fine point finding.  Estimate the transform on small copies, then match full resolution tiles
+# and keep the matches that agree with the coarse estimate
+def pyramid_points(im1, im2, info=None):
+
+    im1y, im1x = im1.shape[:2]
+    im2y, im2x = im2.shape[:2]
+    canvasx, canvasy = max(im1x,im2x), max(im1y,im2y)
+
+    # Gray copies are only made once something misses the feature cache
+    im1Gray = functools.lru_cache(maxsize=None)(lambda: grayscale(im1))
+    im2Gray = functools.lru_cache(maxsize=None)(lambda: grayscale(im2))
+
+    # Coarse level on a shared canvas no larger than PYRAMID_SIZE
+    factor = min(1, PYRAMID_SIZE/max(canvasx, canvasy))
+    coarsex, coarsey = max(1, int(round(canvasx*factor))), max(1, int(round(canvasy*factor)))
+    points1, points2 = sift_match(lambda: bicubic_resize_bc(im1Gray(), (coarsex,coarsey)), lambda: bicubic_resize_bc(im2Gray(), (coarsex,coarsey)),
+                                  *level_keys(info, 'coarse:{:d}x{:d}'.format(coarsex, coarsey)))
+    if len(points1) <= 5:
+        raise ValueError('Not enough matching points found')
+    points1 = points1*np.float32([im1x/coarsex, im1y/coarsey])
+    points2 = points2*np.float32([im2x/coarsex, im2y/coarsey])
+
+    prior, inliers = cv2.estimateAffine2D(points1, points2, cv2.RANSAC)
+    if prior is None:
+        raise ValueError('No coarse transform found')
+    levels = [int(inliers.sum())]
+
+    if factor < 1:
+        inverse = cv2.invertAffineTransform(prior)
+        tolerance = PYRAMID_TOLERANCE*max(im2x/coarsex, im2y/coarsey)
+        margin = tolerance*max(im1x/im2x, im1y/im2y)
+        tilex, tiley = PYRAMID_TILE*im2x/canvasx, PYRAMID_TILE*im2y/canvasy
+        fine1, fine2 = [], []
+
+        for centrey in (np.arange(PYRAMID_TILES) + 0.5)*im2y/PYRAMID_TILES:
+            for centrex in (np.arange(PYRAMID_TILES) + 0.5)*im2x/PYRAMID_TILES:
+
+                # Tile of image 2 and the region of image 1 the coarse transform maps onto it
+                x0, x1 = int(max(0, centrex - tilex/2)), int(min(im2x, centrex + tilex/2))
+                y0, y1 = int(max(0, centrey - tiley/2)), int(min(im2y, centrey + tiley/2))
+                corners = np.float32([[x0,y0],[x1,y0],[x0,y1],[x1,y1]]) @ inverse[:,:2].T + inverse[:,2]
+                u0, u1 = int(max(0, corners[:,0].min() - margin)), int(min(im1x, corners[:,0].max() + margin))
+                v0, v1 = int(max(0, corners[:,1].min() - margin)), int(min(im1y, corners[:,1].max() + margin))
+                if x1 - x0 < 16 or y1 - y0 < 16 or u1 - u0 < 16 or v1 - v0 < 16:
+                    continue
+
+                # Match both tiles at the resolution of the shared canvas
+                size1 = (max(1, int(round((u1-u0)*canvasx/im1x))), max(1, int(round((v1-v0)*canvasy/im1y))))
+                size2 = (max(1, int(round((x1-x0)*canvasx/im2x))), max(1, int(round((y1-y0)*canvasy/im2y))))
+                key1, key2 = level_keys(info, 'tile')
+                if key1 is not None:
+                    key1 = '{:s}:{:d},{:d},{:d},{:d}:{:d}x{:d}'.format(key1, u0, v0, u1, v1, *size1)
+                    key2 = '{:s}:{:d},{:d},{:d},{:d}:{:d}x{:d}'.format(key2, x0, y0, x1, y1, *size2)
+                tile1, tile2 = sift_match(lambda: bicubic_resize_bc(im1Gray()[v0:v1,u0:u1], size1), lambda: bicubic_resize_bc(im2Gray()[y0:y1,x0:x1], size2), key1, key2)
+                tile1 = tile1*np.float32([(u1-u0)/size1[0], (v1-v0)/size1[1]]) + np.float32([u0, v0])
+                tile2 = tile2*np.float32([(x1-x0)/size2[0], (y1-y0)/size2[1]]) + np.float32([x0, y0])
+
+                keep = np.linalg.norm(tile1 @ prior[:,:2].T + prior[:,2] - tile2, axis=1) < tolerance
+                fine1.append(tile1[keep])
+                fine2.append(tile2[keep])
+
+        fine1 = np.concatenate(fine1) if fine1 else np.zeros((0,2), np.float32)
+        fine2 = np.concatenate(fine2) if fine2 else np.zeros((0,2), np.float32)
+        levels.append(len(fine1))
+        if len(fine1) > 5:
+            points1, points2 = fine1, fine2
+
+    if info is not None:
+        info['levels'] = levels
+
+    return points1.astype(np.float32).reshape(-1,1,2), points2.astype(np.float32).reshape(-1,1,2)
+
+# Largest all valid rectangle of a bool mask, returns top, left, bottom, right inclusive.  Row by row
+# maximal rectangle scan with the column bounds of every row found by running max/min accumulations
+def largest_rectangle(mask):
+    rows, cols = mask.shape
+    index = np.arange(cols)
+    height = np.zeros(cols, np.int64)
+    left = np.zeros(cols, np.int64)
+    right = np.full(cols, cols)
+    best, rect = 0, None
+
+    for row in range(rows):
+        valid = mask[row]
+        height = np.where(valid, height + 1, 0)
+        left = np.where(valid, np.maximum(left, np.maximum.accumulate(np.where(valid, 0, index + 1))), 0)
+        right = np.where(valid, np.minimum(right, np.minimum.accumulate(np.where(valid, cols, index)[::-1])[::-1]), cols)
+        area = (right - left)*height
+        col = int(np.argmax(area))
+        if area[col] > best:
+            best = area[col]
+            rect = [row - height[col] + 1, left[col], row, right[col] - 1]
+
+    return rect
+
+# Push each side of a valid rectangle outwards for as long as the new rows or columns are fully valid
+def grow_rectangle(invalid, rect):
+    rows, cols = invalid.shape[0] - 1, invalid.shape[1] - 1
+    top, left, bottom, right = rect
+
+    def bad_rows(r, c0, c1):
+        return invalid[r+1,c1+1] - invalid[r,c1+1] - invalid[r+1,c0] + invalid[r,c0]
+    def bad_cols(c, r0, r1):
+        return invalid[r1+1,c+1] - invalid[r1+1,c] - invalid[r0,c+1] + invalid[r0,c]
+
+    grown = True
+    while grown:
+        grown = False
+        bad = np.flatnonzero(bad_rows(np.arange(top), left, right))
+        if (bad[-1] + 1 if bad.size else 0) < top:
+            top, grown = (bad[-1] + 1 if bad.size else 0), True
+        bad = np.flatnonzero(bad_rows(np.arange(bottom + 1, rows), left, right))
+        if (bad[0] if bad.size else rows - bottom - 1) > 0:
+            bottom, grown = bottom + (bad[0] if bad.size else rows - bottom - 1), True
+        bad = np.flatnonzero(bad_cols(np.arange(left), top, bottom))
+        if (bad[-1] + 1 if bad.size else 0) < left:
+            left, grown = (bad[-1] + 1 if bad.size else 0), True
+        bad = np.flatnonzero(bad_cols(np.arange(right + 1, cols), top, bottom))
+        if (bad[0] if bad.size else cols - right - 1) > 0:
+            right, grown = right + (bad[0] if bad.size else cols - right - 1), True
+
+    return [top, left, bottom, right]
+
+# Find the largest usable rectangle in the valid region of a transformed dummy mask
+@stage('find_rectangle')
 def find_rectangle(arr):
 
-    # Find the center of mass of the transform
-    arrrow, arrcol = arr.shape
-    rowCoM, colCoM = np.around(ndimage.center_of_mass(arr)).astype('int')
-    CoM = np.array([rowCoM,colCoM])
-    pntA, pntB, pntC, pntD = CoM[:], CoM[:], CoM[:], CoM[:]
-    Top, Right, Bottom, Left = True, True, True, True
-
-    # Increase the borders clockwise until the perimeter of the transform runs out of bounds
-    while Top or Right or Bottom or Left:
-        if Top:
-            if pntA[0] >= 2 and np.min(arr[pntA[0]-2,pntA[1]:pntB[1]+1]) == 1:
-                pntA, pntB = pntA + [-2,0], pntB + [-2,0]
-            else:
-                if pntA[0] >= 1 and np.min(arr[pntA[0]-1,pntA[1]:pntB[1]+1]) == 1:
-                    pntA, pntB = pntA + [-1,0], pntB + [-1,0]
-                    Top = False
-                else:
-                    Top = False
-
-        if Right:
-            if pntD[1] <= arrcol - 3 and np.min(arr[pntB[0]:pntD[0]+1,pntB[1]+2]) == 1:
-                pntB, pntD = pntB + [0,2], pntD + [0,2]
-            else:
-                if pntB[1] <= arrcol - 2 and np.min(arr[pntB[0]:pntD[0]+1,pntB[1]+1]) == 1:
-                    pntB, pntD = pntB + [0,1], pntD + [0,1]
-                    Right = False
-                else:
-                    Right = False
-
-        if Bottom:
-            if pntD[0] <= arrrow - 3 and np.min(arr[pntC[0]+2,pntC[1]:pntD[1]+1]) == 1:
-                pntC, pntD = pntC + [2,0], pntD + [2,0]
-            else:
-                if pntD[0] <= arrrow - 2 and np.min(arr[pntC[0]+1,pntC[1]:pntD[1]+1]) == 1:
-                    pntC, pntD = pntC + [1,0], pntD + [1,0]
-                    Bottom = False
-                else:
-                    Bottom = False
-
-        if Left:
-            if pntA[1] >= 2 and np.min(arr[pntA[0]:pntC[0]+1,pntA[1]-2]) == 1:
-                pntA, pntC = pntA + [0,-2], pntC + [0,-2]
-            else:
-                if pntA[1] >= 1 and np.min(arr[pntA[0]:pntC[0]+1,pntA[1]-1]) == 1:
-                    pntA, pntC = pntA + [0,-1], pntC + [0,-1]
-                    Left = False
-                else:
-                    Left = False
-
-    return pntA, pntD
-
-def Align_Process(im1, im2, im1ref, im2ref):
-
-    # Make dummy array the dimensions of image 1
-    im1y, im1x, _ = im1ref.shape
-    im2y, im2x, _ = im2ref.shape
-    white1 = np.zeros((im1y,im1x))
-    white1.fill(1)
-
-    if Manual:
-        points1, points2 = manual_points(im1ref, im2ref)
+    mask = arr if arr.dtype == bool else arr == 1
+    arrrow, arrcol = mask.shape
+
+    # Search a downscaled mask where a block only counts as valid if all of its pixels are
+    factor = int(math.ceil(max(arrrow, arrcol)/RECT_SIZE))
+    rect = None
+    if factor > 1:
+        padded = np.zeros((-(-arrrow//factor)*factor, -(-arrcol//factor)*factor), bool)
+        padded[:arrrow,:arrcol] = mask
+        small = padded.reshape(padded.shape[0]//factor, factor, padded.shape[1]//factor, factor).all((1,3))
+        rect = largest_rectangle(small)
+        if rect is not None:
+            rect = [rect[0]*factor, rect[1]*factor, min(arrrow, (rect[2]+1)*factor) - 1, min(arrcol, (rect[3]+1)*factor) - 1]
+    if rect is None:
+        rect = largest_rectangle(mask)
+    if rect is None:
+        raise ValueError('Transformed image has no usable region')
+
+    # Refine the block aligned rectangle at full resolution with an integral image of invalid pixels
+    invalid = cv2.integral((~mask).view(np.uint8))
+    top, left, bottom, right = grow_rectangle(invalid, rect)
+
+    return np.array([top, left]), np.array([bottom, right])
+
+# Clip a convex polygon to the pixel centres of a width x height image
+def clip_polygon(poly, width, height):
+    for axis, limit, below in ((0, 0, False), (0, width - 1, True), (1, 0, False), (1, height - 1, True)):
+        inside = lambda p: p[axis] <= limit if below else p[axis] >= limit
+        clipped = []
+        for i in range(len(poly)):
+            p, q = poly[i-1], poly[i]
+            if inside(p) != inside(q):
+                t = (limit - p[axis])/(q[axis] - p[axis])
+                clipped.append(p + t*(q - p))
+            if inside(q):
+                clipped.append(q)
+        poly = clipped
+        if not poly:
+            break
+    return poly
+
+# Left and right edges of a convex polygon along each row in ys, inf and -inf where the row misses it
+def polygon_rows(poly, ys):
+    left = np.full(len(ys), np.inf)
+    right = np.full(len(ys), -np.inf)
+    for i in range(len(poly)):
+        p, q = poly[i-1], poly[i]
+        on = (ys >= min(p[1], q[1])) & (ys <= max(p[1], q[1]))
+        if p[1] == q[1]:
+            x0, x1 = min(p[0], q[0]), max(p[0], q[0])
+        else:
+            x0 = x1 = p[0] + (ys - p[1])*(q[0] - p[0])/(q[1] - p[1])
+        left = np.where(on, np.minimum(left, x0), left)
+        right = np.where(on, np.maximum(right, x1), right)
+    return left, right
+
+# Largest rectangle of pixel centres inside the region image 1 covers after transform h, computed from the
+# projected corners.  The region is convex, so a rectangle fits if its corner rows do.  Returns None when
+# the projection is not a convex quadrilateral and the region has to be rasterized instead
+@stage('find_rectangle')
+def transform_rectangle(h, im1size, im2size):
+    im1x, im1y = im1size
+    im2x, im2y = im2size
+    if h.shape[0] == 2:
+        h = np.vstack([h, [0, 0, 1]])
+
+    corners = np.array([[0, 0, 1], [im1x - 1, 0, 1], [im1x - 1, im1y - 1, 1], [0, im1y - 1, 1]], np.float64) @ h.T
+    if np.any(corners[:,2] <= 0):
+        return None
+    corners = corners[:,:2]/corners[:,2:]
+    edges = np.roll(corners, -1, 0) - corners
+    turns = edges[:,0]*np.roll(edges, -1, 0)[:,1] - edges[:,1]*np.roll(edges, -1, 0)[:,0]
+    if not (np.all(turns > 0) or np.all(turns < 0)):
+        return None
+
+    poly = clip_polygon(list(corners), im2x, im2y)
+    if len(poly) < 3:
+        raise ValueError('Transformed image has no usable region')
+    poly = np.array(poly)
+
+    ys = np.arange(math.ceil(poly[:,1].min() - 1e-6), math.floor(poly[:,1].max() + 1e-6) + 1)
+    left, right = polygon_rows(poly, ys)
+    left, right = np.ceil(left - 1e-6), np.floor(right + 1e-6)
+
+    def best(tops, bottoms):
+        tops, bottoms = tops[:,None], bottoms[None,:]
+        width = np.minimum(right[tops], right[bottoms]) - np.maximum(left[tops], left[bottoms]) + 1
+        area = np.where((bottoms >= tops) & (width > 0), (bottoms - tops + 1)*width, 0)
+        i, j = np.unravel_index(np.argmax(area), area.shape)
+        return tops[i,0], bottoms[0,j]
+
+    # Search evenly spaced rows, then every row around the best coarse pair
+    step = max(1, int(math.ceil(len(ys)/RECT_SIZE)))
+    top, bottom = best(np.arange(0, len(ys), step), np.append(np.arange(0, len(ys), step), len(ys) - 1))
+    for _ in range(2):
+        top, bottom = best(np.arange(max(0, top - step), min(len(ys), top + step + 1)),
+                           np.arange(max(0, bottom - step), min(len(ys), bottom + step + 1)))
+
+    l, r = max(left[top], left[bottom]), min(right[top], right[bottom])
+    if r < l:
+        raise ValueError('Transformed image has no usable region')
+    return np.array([ys[top], l]).astype(int), np.array([ys[bottom], r]).astype(int)
+
+# Largest even size not above n that phase correlation won't pad, padded or odd sizes bias the peak by up to half a pixel
+def dft_size(n):
+    while n > 2 and (n % 2 or cv2.getOptimalDFTSize(n) != n):
+        n -= 1
+    return n
+
+# Check a transform carried over from the previous frame by warping a small copy of image 1 onto image 2
+# and phase correlating the two.  Returns the transform corrected by the residual shift, or None when it
+# doesn't fit, for example after a scene cut
+@stage('estimate')
+def track_transform(prior, im1, im2):
+    im1y, im1x = im1.shape[:2]
+    im2y, im2x = im2.shape[:2]
+    factor1 = min(1, TRACK_SIZE/max(im1x, im1y))
+    factor2 = min(1, TRACK_SIZE/max(im2x, im2y))
+    size1 = (max(1, int(round(im1x*factor1))), max(1, int(round(im1y*factor1))))
+    size2 = (max(1, int(round(im2x*factor2))), max(1, int(round(im2y*factor2))))
+    small1 = cv2.resize(grayscale(im1), size1, interpolation=cv2.INTER_AREA)
+    small2 = cv2.resize(grayscale(im2), size2, interpolation=cv2.INTER_AREA)
+
+    full = prior if prior.shape[0] == 3 else np.vstack([prior, [0, 0, 1]])
+    ratio2 = (size2[0]/im2x, size2[1]/im2y)
+    reduce = lambda h: np.diag([ratio2[0], ratio2[1], 1]) @ h @ np.diag([im1x/size1[0], im1y/size1[1], 1])
+    # Transforms map pixel edges, which area reduction only scales, while warpPerspective maps pixel centres
+    edge = np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+
+    # The sub pixel peak is only exact near zero shift, so later passes measure what is left after the last
+    for i in range(TRACK_PASSES):
+        small = reduce(full)
+        warped = cv2.warpPerspective(small1, np.linalg.inv(edge) @ small @ edge, size2, flags=cv2.INTER_LINEAR)
+
+        # Compare only where the warped image covers image 2
+        try:
+            usable = transform_rectangle(small, size1, size2)
+        except ValueError:
+            return None
+        if usable is None:
+            return None
+        (top, left), (bottom, right) = usable
+        if bottom - top < 16 or right - left < 16:
+            return None
+        bottom, right = top + dft_size(bottom - top + 1) - 1, left + dft_size(right - left + 1) - 1
+        warped = warped[top:bottom+1,left:right+1].astype(np.float32)
+        target = small2[top:bottom+1,left:right+1].astype(np.float32)
+
+        (dx, dy), response = cv2.phaseCorrelate(warped, target, cv2.createHanningWindow(warped.shape[::-1], cv2.CV_32F))
+        if i == 0 and (response < TRACK_RESPONSE or math.hypot(dx, dy) > TRACK_SHIFT):
+            return None
+        full = np.array([[1, 0, dx/ratio2[0]], [0, 1, dy/ratio2[1]], [0, 0, 1]]) @ full
+
+    return full[:prior.shape[0]]
+
+# Magnitude spectrum of an image windowed and zero padded to PHASE_SIZE square, high pass filtered so the
+# low frequencies don't swamp the log-polar correlation
+def phase_spectrum(image):
+    canvas = np.zeros((PHASE_SIZE, PHASE_SIZE), np.float32)
+    canvas[:image.shape[0],:image.shape[1]] = (image - image.mean())*cv2.createHanningWindow(image.shape[::-1], cv2.CV_32F)
+    freq = np.cos(np.pi*(np.arange(PHASE_SIZE) - PHASE_SIZE//2)/PHASE_SIZE)
+    cosine = np.outer(freq, freq)
+    return (np.abs(np.fft.fftshift(np.fft.fft2(canvas)))*(1 - cosine)*(2 - cosine)).astype(np.float32)
+
+# Scale and translation from image 1 to image 2 without features, for pairs that are only cropped and
+# scaled.  Log-polar phase correlation of the magnitude spectra finds the scale on copies brought to about
+# the same pixel scale, phase correlation the translation, then tiles of image 2 at full size refine x and y
+# separately.  Returns None unless the tiles agree and a small feature check confirms the transform
+@stage('estimate')
+def phase_transform(im1, im2, info=None):
+    im1y, im1x = im1.shape[:2]
+    im2y, im2x = im2.shape[:2]
+    gray1 = grayscale(im1)
+    gray2 = grayscale(im2)
+
+    # Scale from the log-polar spectra, starting from the size ratio
+    guess = math.sqrt(im2x*im2y/(im1x*im1y))
+    factor = min(1, PHASE_SIZE/max(im2x, im2y, im1x*guess, im1y*guess))
+    size1 = (max(1, int(im1x*guess*factor)), max(1, int(im1y*guess*factor)))
+    size2 = (max(1, int(im2x*factor)), max(1, int(im2y*factor)))
+    if min(size1 + size2) < 32:
+        return None
+    small1 = cv2.resize(gray1, size1, interpolation=cv2.INTER_AREA).astype(np.float32)
+    small2 = cv2.resize(gray2, size2, interpolation=cv2.INTER_AREA).astype(np.float32)
+    polar = lambda image: cv2.warpPolar(phase_spectrum(image), (PHASE_SIZE, PHASE_SIZE), (PHASE_SIZE/2, PHASE_SIZE/2), PHASE_SIZE/2, cv2.WARP_POLAR_LOG + cv2.INTER_LINEAR)
+    (logscale, angle), _ = cv2.phaseCorrelate(polar(small1), polar(small2))
+
+    # Magnitude spectra are point symmetric, so the angle is only known up to half a turn
+    if abs((angle*360/PHASE_SIZE + 90) % 180 - 90) > PHASE_ANGLE:
+        return None
+    scale1 = guess*math.exp(-logscale*math.log(PHASE_SIZE/2)/PHASE_SIZE)
+
+    # Translation between the rescaled copies on a shared canvas
+    size1 = (max(1, int(im1x*scale1*factor)), max(1, int(im1y*scale1*factor)))
+    canvasx, canvasy = max(size1[0], size2[0]), max(size1[1], size2[1])
+    canvas1 = np.zeros((canvasy, canvasx), np.float32)
+    canvas2 = np.zeros((canvasy, canvasx), np.float32)
+    canvas1[:size1[1],:size1[0]] = cv2.resize(gray1, size1, interpolation=cv2.INTER_AREA)
+    canvas2[:size2[1],:size2[0]] = small2
+    (dx, dy), _ = cv2.phaseCorrelate(canvas1, canvas2, cv2.createHanningWindow((canvasx, canvasy), cv2.CV_32F))
+    h = np.array([[scale1, 0, dx/factor], [0, scale1, dy/factor]])
+
+    # Refine on full size tiles of image 2 against image 1 warped onto them, fitting scale and offset per axis
+    for _ in range(PHASE_PASSES):
+        # A poor guess can leave no usable region, feature matching gets the pair then
+        try:
+            usable = transform_rectangle(h, (im1x,im1y), (im2x,im2y))
+        except ValueError:
+            return None
+        if usable is None:
+            return None
+        (top, left), (bottom, right) = usable
+        tile = int(min(PHASE_TILE, (bottom - top + 1)/PHASE_TILES, (right - left + 1)/PHASE_TILES))
+        if tile < 32:
+            return None
+        xs = (left + (np.arange(PHASE_TILES) + 0.5)*(right - left + 1)/PHASE_TILES - tile/2).astype(int)
+        ys = (top + (np.arange(PHASE_TILES) + 0.5)*(bottom - top + 1)/PHASE_TILES - tile/2).astype(int)
+        corners = [(x0, y0) for y0 in ys for x0 in xs]
+        target = np.stack([gray2[y0:y0+tile,x0:x0+tile] for x0, y0 in corners]).astype(np.float32)
+        warped = np.stack([cv2.warpAffine(gray1, h - np.array([[0, 0, x0], [0, 0, y0]]), (tile, tile), flags=cv2.INTER_LINEAR) for x0, y0 in corners]).astype(np.float32)
+        dx, dy, response = phase_shifts(target, warped)
+
+        keep = response >= PHASE_RESPONSE
+        centres = np.array(corners, np.float64)[keep] + tile/2
+        if len(np.unique(centres[:,0])) < 2 or len(np.unique(centres[:,1])) < 2:
+            return None
+        residual = []
+        for axis, shift in ((0, dx[keep]), (1, dy[keep])):
+            design = np.stack([centres[:,axis], np.ones(len(centres))], 1)
+            (gain, offset), *_ = np.linalg.lstsq(design, centres[:,axis] + shift, rcond=None)
+            residual.append(design @ (gain, offset) - centres[:,axis] - shift)
+            h[axis] = gain*h[axis]
+            h[axis,2] += offset
+    rms = float(np.sqrt(np.mean(np.square(residual))))
+    if rms > PHASE_TOLERANCE:
+        return None
+
+    # Small feature check, most matches have to agree with the transform
+    check1 = min(1, PHASE_CHECK/max(im1x, im1y))
+    check2 = min(1, PHASE_CHECK/max(im2x, im2y))
+    points1, points2 = sift_match(cv2.resize(gray1, (max(1, int(im1x*check1)), max(1, int(im1y*check1))), interpolation=cv2.INTER_AREA),
+                                  cv2.resize(gray2, (max(1, int(im2x*check2)), max(1, int(im2y*check2))), interpolation=cv2.INTER_AREA))
+    points1, points2 = points1.reshape(-1,2)/check1, points2.reshape(-1,2)/check2
+    agree = int((np.linalg.norm(points1 @ h[:,:2].T + h[:,2] - points2, axis=1) < 2/check2).sum())
+    if agree < PHASE_CHECK_MATCHES or agree < len(points1)/2:
+        return None
+
+    # Phase correlation measures shifts between pixel centres, the feature path and the renderer scale pixel
+    # indices with no centre term
+    for axis in (0, 1):
+        h[axis,2] += (1 - h[axis,axis])/2
+
+    if info is not None:
+        info['phase'] = True
+        info['fit'] = {'matches': len(points1), 'inliers': agree, 'residual': rms}
+    return h
+
+# Number of matched points, RANSAC inliers and the RMS reprojection error of the inliers in image 2 pixels.
+# Thin plate splines pass through every point, so they only report the number of matches
+def match_fit(h, points1, points2, inliers):
+    points1, points2 = points1.reshape(-1,2).astype(np.float64), points2.reshape(-1,2).astype(np.float64)
+    fit = {'matches': len(points1)}
+    if h is None or inliers is None:
+        return fit
+    keep = inliers.ravel().astype(bool)
+    if h.shape[0] == 3:
+        projected = cv2.perspectiveTransform(points1[keep].reshape(-1,1,2), h).reshape(-1,2)
     else:
-        points1, points2 = auto_points(im1ref, im2ref)
+        projected = points1[keep] @ h[:,:2].T + h[:,2]
+    error = np.linalg.norm(projected - points2[keep], axis=1)
+    fit['inliers'] = int(keep.sum())
+    fit['residual'] = float(np.sqrt(np.mean(error**2))) if len(error) else None
+    return fit
+
+# Shrink a mode 1 crop of image 2 in place to start and end on multiples of snap, so it is a whole number of
+# LR pixels at every scale and starts on a whole LR pixel
+def snap_crop(top_left, bottom_right):
+    top_left[0] = -(-top_left[0]//snap)*snap
+    top_left[1] = -(-top_left[1]//snap)*snap
+    bottom_right[0] = bottom_right[0] - (bottom_right[0] - top_left[0] + 1) % snap
+    bottom_right[1] = bottom_right[1] - (bottom_right[1] - top_left[1] + 1) % snap
+
+def Align_Process(im1, im2, im1ref, im2ref, info=None):
+
+    im1y, im1x = im1ref.shape[:2]
+    im2y, im2x = im2ref.shape[:2]
+
+    # Reuse the transform of the previous frame in a sequence when it still fits
+    h = None
+    prior = info.get('prior') if info is not None else None
+    if prior is not None and not Manual:
+        h = track_transform(prior, im1ref, im2ref)
+        info['tracked'] = h is not None
+
+    # Scale and translation only pairs try phase correlation before feature matching
+    if h is None and phase and not (Manual or Homography or rotate):
+        h = phase_transform(im1ref, im2ref, info)
+
+    if h is None:
+        if Manual:
+            points1, points2 = manual_points(im1ref, im2ref, review_seeds(im1ref, im2ref, info) if review is not None else None)
+            if info is not None and review is not None:
+                info['reviewed'] = True
+        else:
+            points1, points2 = auto_points(im1ref, im2ref, info)
 
     # Find transform based on points
     if Homography:
         smat = np.array([[scale,0,0],[0,scale,0],[0,0,1]])
-        h, _ = cv2.findHomography(points1, points2, cv2.RANSAC)
-        warp1 = cv2.warpPerspective(white1,h,(im2x,im2y),flags=0)
+        if h is None:
+            with stage('estimate'):
+                h, inliers = cv2.findHomography(points1, points2, cv2.RANSAC)
 
     elif warp:
-        white1 = np.pad(white1,[(0,max(0,im2y-im1y)),(0,max(0,im2x-im1x))])
-        warp1 = WarpImage_TPS(points1, points2, white1, 0)
-        warp1 = warp1[0:im2y,0:im2x]
+        # Pixels of image 2 whose nearest source pixel lies inside image 1, from the same spline grid the
+        # image is warped with
+        grid = tps_grid(points1, points2, (im2x, im2y))
+        mapx, mapy = grid_map(grid, 1, 0, 0, im2x, im2y)
+        warp1 = (mapx >= -0.5) & (mapx < im1x - 0.5) & (mapy >= -0.5) & (mapy < im1y - 0.5)
 
     else:
         smat = np.array([[scale,0],[0,scale]])
-        h, _ = cv2.estimateAffine2D(points1, points2, cv2.RANSAC)
-        if not rotate:
-            sx = math.sqrt(h[0,0]**2+h[1,0]**2)
-            sy = math.sqrt(h[0,1]**2+h[1,1]**2)
-            h[:,:2] = np.array([[sx,0],[0,sy]])
-
-        warp1 = cv2.warpAffine(white1,h,(im2x,im2y),flags=0)
-
-    # Get usable overlapping region
-    top_left, bottom_right = find_rectangle(warp1)
+        if h is None:
+            with stage('estimate'):
+                h, inliers = cv2.estimateAffine2D(points1, points2, cv2.RANSAC)
+            if not rotate:
+                sx = math.sqrt(h[0,0]**2+h[1,0]**2)
+                sy = math.sqrt(h[0,1]**2+h[1,1]**2)
+                h[:,:2] = np.array([[sx,0],[0,sy]])
+
+    # Smooth tracked transforms against the previous output to reduce jitter between neighbouring crops.  Only
+    # differences within the tracking noise are averaged, and the next frame tracks from the measured transform,
+    # so the lag can't build up over a slow drift
+    if info is not None and info.get('tracked'):
+        info['measured'] = h.copy()
+        shown = info.get('shown')
+        if shown is not None and math.hypot(*(h - shown)[:2,2]) <= SEQUENCE_JITTER:
+            h = SEQUENCE_SMOOTHING*shown + (1 - SEQUENCE_SMOOTHING)*h
+    if info is not None and not warp:
+        info['h'] = h.copy()
+
+    # Keep how well the matches fit for scoring, so the score needs no matching of its own
+    if info is not None and not info.get('tracked') and not info.get('phase'):
+        info['fit'] = match_fit(None if warp else h, points1, points2, None if warp else inliers)
+
+    # Get usable overlapping region, rasterizing it only when it can't be found from the transform corners
+    usable = None if warp else transform_rectangle(h, (im1x,im1y), (im2x,im2y))
+    if usable is None:
+        if not warp:
+            white1 = np.ones((im1y,im1x), np.uint8)
+            if Homography:
+                warp1 = cv2.warpPerspective(white1,h,(im2x,im2y),flags=0)
+            else:
+                warp1 = cv2.warpAffine(white1,h,(im2x,im2y),flags=0)
+        usable = find_rectangle(warp1)
+    top_left, bottom_right = usable
 
     if not warp:
         newh = smat @ h
 
     # Ensure integer multiple scale down for mode 1
     if mode == 1:
-        bottom_right[0] = bottom_right[0] - (bottom_right[0] - top_left[0] + 1) % (1/scale)
-        bottom_right[1] = bottom_right[1] - (bottom_right[1] - top_left[1] + 1) % (1/scale)
-
-    # Transform image 1
-    if Homography:
-        im1 = cv2.warpPerspective(im1,newh,(int(scale*(bottom_right[1]+1)),int(scale*(bottom_right[0]+1))),flags=cv2.INTER_LANCZOS4)
-    elif warp:
-        im1 = np.pad(im1,[(0,int(np.around(max(0,scale*im2y-im1y)))),(0,int(np.around(max(0,scale*im2x-im1x)))),(0,0)])
-        im1 = WarpImage_TPS(points1, scale*points2, im1, 1)
-        im1 = im1[:int(scale*(bottom_right[0]+1)),:int(scale*(bottom_right[1]+1))]
+        snap_crop(top_left, bottom_right)
+
+    if info is not None:
+        info['crop'] = [int(top_left[0]), int(top_left[1]), int(bottom_right[0]), int(bottom_right[1])]
+        info['kind'] = 'homography' if Homography else 'tps' if warp else 'affine'
+        if warp or Manual:
+            info['points'] = [points1.reshape(-1,2).tolist(), points2.reshape(-1,2).tolist()]
+        if not warp:
+            info['transform'] = newh.tolist()
+
+    # Render every scale from the one transform and crop
+    kind = 'homography' if Homography else 'tps' if warp else 'affine'
+    renders = []
+    for factor in scales:
+        transform = (points1, points2, grid) if warp else rescale(newh, factor/scale)
+        renders.append(Render_Aligned(im1, im2, kind, transform, top_left, bottom_right, factor, native=factor == scale))
+    return renders
+
+# Transform onto an output ratio times bigger, with the centres of the output pixels covering each pixel of
+# the old output kept centred on it
+def rescale(transform, ratio):
+    offset = (ratio - 1)/2
+    adjust = np.array([[ratio, 0, offset], [0, ratio, offset], [0, 0, 1]])
+    full = transform if transform.shape[0] == 3 else np.vstack([transform, [0, 0, 1]])
+    return (adjust @ full)[:transform.shape[0]]
+
+# Coordinates in the source image of every pixel of an output tile, from the inverse affine or projective
+# transform.  Each pixel only depends on its own position, so tiles put together match one big map exactly
+def tile_map(inverse, x0, y0, width, height):
+    xs, ys = np.meshgrid(np.arange(x0, x0 + width, dtype=np.float64), np.arange(y0, y0 + height, dtype=np.float64))
+    mapx = inverse[0,0]*xs + inverse[0,1]*ys + inverse[0,2]
+    mapy = inverse[1,0]*xs + inverse[1,1]*ys + inverse[1,2]
+    if inverse.shape[0] == 3:
+        w = inverse[2,0]*xs + inverse[2,1]*ys + inverse[2,2]
+        mapx, mapy = mapx/w, mapy/w
+    return mapx.astype(np.float32), mapy.astype(np.float32)
+
+# Source positions of an output tile the way cv2.warpAffine computes them: the inverse transform worked out
+# in the same order of operations, and positions rounded to 1/32 pixel in fixed point, given as whole pixels
+# and the interpolation table index remap takes.  Tiles put together match the untiled warpAffine exactly
+def affine_fixed_map(transform, nearest, x0, y0, width, height):
+    (a, b, c), (d, e, f) = transform
+    det = a*e - b*d
+    det = 1/det if det != 0 else 0
+    a, b, d, e = e*det, b*-det, d*-det, a*det
+    c, f = -a*c - b*f, -d*c - e*f
+
+    # Fixed point with 10 fractional bits, rounded to the nearest pixel or to 5 bits as warpAffine does
+    xs, ys = np.arange(x0, x0 + width), np.arange(y0, y0 + height)
+    delta = 512 if nearest else 16
+    fx = np.rint(a*xs*1024).astype(np.int64)[None,:] + np.rint((b*ys + c)*1024).astype(np.int64)[:,None] + delta
+    fy = np.rint(d*xs*1024).astype(np.int64)[None,:] + np.rint((e*ys + f)*1024).astype(np.int64)[:,None] + delta
+    if nearest:
+        return fx >> 10, fy >> 10, None
+    fx, fy = fx >> 5, fy >> 5
+    return fx >> 5, fy >> 5, ((fy & 31)*32 + (fx & 31)).astype(np.uint16)
+
+# Tile map function of an affine or projective transform from image 1 to the output
+def transform_map(transform, interp):
+    if transform.shape[0] == 2:
+        return functools.partial(affine_fixed_map, transform, interp == cv2.INTER_NEAREST)
+    return functools.partial(tile_map, np.linalg.inv(transform))
+
+# Thin plate spline from image 2 pixels back to image 1, evaluated on a coarse grid of image 2 covering
+# size plus one cell.  With no regularization the spline scales with its control points, so the same grid
+# serves the mask at image 2 size and the image at the output scale
+@stage('estimate')
+def tps_grid(source, target, size):
+    tps = cv2.createThinPlateSplineShapeTransformer()
+    source = source.reshape(1,-1,2).astype(np.float32)
+    target = target.reshape(1,-1,2).astype(np.float32)
+    tps.estimateTransformation(target, source, [cv2.DMatch(i,i,0) for i in range(source.shape[1])])
+
+    gridx = np.arange(0, size[0] + 2*TPS_GRID, TPS_GRID, dtype=np.float32)
+    gridy = np.arange(0, size[1] + 2*TPS_GRID, TPS_GRID, dtype=np.float32)
+    grid = np.stack(np.meshgrid(gridx, gridy), -1).reshape(1,-1,2)
+    _, mapped = tps.applyTransformation(grid)
+    return mapped.reshape(len(gridy), len(gridx), 2)
+
+# Source coordinates of an output tile, bilinearly interpolated from a coarse spline grid.  Output pixels
+# are divided by the output scale to get image 2 positions on the grid
+def grid_map(grid, inv_scale, x0, y0, width, height):
+    posx = np.arange(x0, x0 + width)*inv_scale/TPS_GRID
+    posy = np.arange(y0, y0 + height)*inv_scale/TPS_GRID
+    ix, iy = np.floor(posx).astype(int), np.floor(posy).astype(int)
+    fx, fy = (posx - ix).astype(np.float32)[None,:,None], (posy - iy).astype(np.float32)[:,None,None]
+
+    rows = np.arange(iy.min(), iy.max() + 2)
+    across = grid[rows][:,ix]*(1 - fx) + grid[rows][:,ix+1]*fx
+    mapped = across[iy - rows[0]]*(1 - fy) + across[iy - rows[0] + 1]*fy
+    return mapped[...,0], mapped[...,1]
+
+# Warp an image into the output region from origin to size one tile at a time, with mapping giving the
+# source coordinates of each tile, as float maps or as the fixed point maps of affine_fixed_map.  Each tile
+# only reads the source window it maps from plus a halo for the interpolation taps, so memory stays bounded
+# by the tile size.  Window offsets are whole pixels and are subtracted exactly, so the result is bit
+# identical for every tile size
+def warp_tiled(image, mapping, size, interp, origin=(0, 0)):
+    width, height = size
+    imy, imx = image.shape[:2]
+
+    out = np.zeros((max(0, height - origin[1]), max(0, width - origin[0])) + image.shape[2:], image.dtype)
+    step = TILE if TILE > 0 else max(width, height, 1)
+    for y0 in range(origin[1], height, step):
+        for x0 in range(origin[0], width, step):
+            tilex, tiley = min(step, width - x0), min(step, height - y0)
+            mapx, mapy, *table = mapping(x0, y0, tilex, tiley)
+            valid = np.isfinite(mapx) & np.isfinite(mapy)
+            if not valid.any():
+                continue
+            left = int(max(0, min(imx, np.floor(mapx[valid].min()) - TILE_HALO)))
+            right = int(max(0, min(imx, np.floor(mapx[valid].max()) + TILE_HALO + 1)))
+            top = int(max(0, min(imy, np.floor(mapy[valid].min()) - TILE_HALO)))
+            bottom = int(max(0, min(imy, np.floor(mapy[valid].max()) + TILE_HALO + 1)))
+            if right <= left or bottom <= top:
+                continue
+            window = np.ascontiguousarray(image[top:bottom,left:right])
+            if table:
+                fixed = np.stack([mapx - left, mapy - top], -1).clip(-32768, 32767).astype(np.int16)
+                tile = cv2.remap(window, fixed, table[0], interp, borderMode=cv2.BORDER_CONSTANT)
+            else:
+                tile = cv2.remap(window, mapx - np.float32(left), mapy - np.float32(top), interp, borderMode=cv2.BORDER_CONSTANT)
+            out[y0-origin[1]:y0-origin[1]+tiley,x0-origin[0]:x0-origin[0]+tilex] = tile
+
+    return out
+
+# Warp an image by an affine or projective transform into the output region from origin to size.  Without
+# tiling this is OpenCV's own warp of the whole output, cropped
+def warp_transform(image, transform, size, interp, origin):
+    if TILE > 0:
+        return warp_tiled(image, transform_map(transform, interp), size, interp, origin)
+    if transform.shape[0] == 3:
+        warped = cv2.warpPerspective(image, transform, size, flags=interp)
+    else:
+        warped = cv2.warpAffine(image, transform, size, flags=interp)
+    return warped[origin[1]:,origin[0]:]
+
+# Transform image 1 onto the usable region of image 2 and crop both.  Shared by alignment and --apply
+@stage('warp')
+def Render_Aligned(im1, im2, kind, transform, top_left, bottom_right, scale, interp=cv2.INTER_LANCZOS4, native=True):
+
+    im1y, im1x = im1.shape[:2]
+    im2y, im2x = im2.shape[:2]
+    scale_avg = 1
+
+    # Extra output scales are warped onto their scale like a homography, image 1 is first reduced with area
+    # averaging where the transform shrinks it so the warp doesn't alias
+    if not native and kind != 'tps':
+        shrink = math.sqrt(abs(np.linalg.det(transform[:2,:2])))
+        if shrink < 1:
+            size = (max(1, int(round(im1x*shrink))), max(1, int(round(im1y*shrink))))
+            im1 = cv2.resize(im1, size, interpolation=cv2.INTER_AREA)
+            # Area reduction keeps pixel centres aligned, so reduced pixel i covers the original around rx*i + (rx-1)/2
+            rx, ry = im1x/size[0], im1y/size[1]
+            transform = transform @ np.array([[rx, 0, (rx - 1)/2], [0, ry, (ry - 1)/2], [0, 0, 1]])
+        kind = 'homography'
+
+    # Transform image 1, rendering only the part that survives the crop
+    if kind == 'homography':
+        origin = (int(scale*top_left[1]), int(scale*top_left[0]))
+        im1 = warp_transform(im1,transform,(int(scale*(bottom_right[1]+1)),int(scale*(bottom_right[0]+1))),interp,origin)
+    elif kind == 'tps':
+        # Reuse the spline grid of the mask when alignment passes it along
+        grid = transform[2] if len(transform) > 2 else tps_grid(transform[0], transform[1], (im2x, im2y))
+        origin = (int(scale*top_left[1]), int(scale*top_left[0]))
+        im1 = warp_tiled(im1,functools.partial(grid_map, grid, 1/scale),(int(scale*(bottom_right[1]+1)),int(scale*(bottom_right[0]+1))),interp,origin)
     else:
         # im1 = cv2.warpAffine(im1,newh,(int(scale*(bottom_right[1]+1)),int(scale*(bottom_right[0]+1))),flags=cv2.INTER_LANCZOS4)
+        newh = transform
         scale_x = newh[0][0]
         scale_y = newh[1][1]
         scale_avg = (scale_y + scale_x) / 2
         h1 = newh / scale_avg
         h1[0][0] = 1
         h1[1][1] = 1
-        im1 = cv2.warpAffine(im1, h1, (int(scale /scale_avg * (bottom_right[1] + 1)), int(scale /scale_avg * (bottom_right[0] + 1))),
-                             flags=cv2.INTER_LANCZOS4)
+        # Rounded, as scale_avg is only about the native ratio and truncating can drop the crop a pixel
+        origin = (int(round(scale/scale_avg*top_left[1])), int(round(scale/scale_avg*top_left[0])))
+        im1 = warp_transform(im1, h1, (int(round(scale /scale_avg * (bottom_right[1] + 1))), int(round(scale /scale_avg * (bottom_right[0] + 1)))),
+                         interp, origin)
         # im1 = bicubic_resize_bc(im1, (int(scale*(bottom_right[1]+1)),int(scale*(bottom_right[0]+1))))
         # with Image.from_array(im1) as img:
         #     # blur_size = min((1 / scale_avg - 1) / 3.5, 250)
@@ -461,23 +1501,74 @@ def Align_Process(im1, im2, im1ref, im2ref):
 
 
     # Crop images
-    im1 = im1[int(scale/scale_avg*top_left[0]):,int(scale/scale_avg*top_left[1]):]
     im2 = im2[top_left[0]:(bottom_right[0]+1),top_left[1]:(bottom_right[1]+1)]
 
     return im1, im2
 
-def align_score(img1, img2):
-
-    # img1 = cv2.resize(img1,(256,256),interpolation=cv2.INTER_LANCZOS4)
-    img1 = bicubic_resize_bc(img1,(256,256))
-    # img2 = cv2.resize(img2,(256,256),interpolation=cv2.INTER_LANCZOS4)
-    img2 = bicubic_resize_bc(img2,(256,256))
-    points1, points2 = auto_points(img1,img2)
-    points1, points2 = ransac(points1,points2)
-    points = points2-points1
-    score = max(1-3*(np.sum(abs(points))/len(points))/100,0)
-
-    return score
+# Phase correlation of a batch of equally sized tiles in one FFT, returns the shift of each tile of a
+# relative to b with a 3x3 centroid around the peak, and the correlation around the peak as the response
+def phase_shifts(a, b):
+    count, tiley, tilex = a.shape
+    window = np.outer(np.hanning(tiley), np.hanning(tilex)).astype(np.float32)
+    fa = np.fft.rfft2((a - a.mean(axis=(1,2), keepdims=True))*window)
+    fb = np.fft.rfft2((b - b.mean(axis=(1,2), keepdims=True))*window)
+    cross = fa*np.conj(fb)
+    cross /= np.maximum(np.abs(cross), 1e-9)
+    corr = np.fft.irfft2(cross, s=(tiley, tilex))
+
+    peaky, peakx = np.unravel_index(corr.reshape(count, -1).argmax(1), (tiley, tilex))
+    offsets = np.arange(-1, 2)
+    rows, cols = (peaky[:,None] + offsets) % tiley, (peakx[:,None] + offsets) % tilex
+    near = np.maximum(corr[np.arange(count)[:,None,None], rows[:,:,None], cols[:,None,:]], 0)
+    response = near.sum(axis=(1,2))
+    weight = np.maximum(response, 1e-9)
+    dy = (peaky + near.sum(2) @ offsets/weight + tiley/2) % tiley - tiley/2
+    dx = (peakx + near.sum(1) @ offsets/weight + tilex/2) % tilex - tilex/2
+    return dx, dy, response
+
+# Normalized cross correlation of each pair of tiles
+def batch_ncc(a, b):
+    a = a - a.mean(axis=(1,2), keepdims=True)
+    b = b - b.mean(axis=(1,2), keepdims=True)
+    return (a*b).sum(axis=(1,2))/np.maximum(np.sqrt((a*a).sum(axis=(1,2))*(b*b).sum(axis=(1,2))), 1e-9)
+
+# Dense metrics of an aligned pair at the LR size, capped at SCORE_SIZE: the residual phase correlation shift
+# of LR against HR in LR pixels, NCC of the gradient magnitudes, and both per tile on a SCORE_TILES grid as a
+# misalignment map.  The score is the gradient NCC discounted by the worst textured tile shift
+@stage('score')
+def alignment_metrics(highres, lowres):
+    lry, lrx = lowres.shape[:2]
+    factor = min(1, SCORE_SIZE/max(lrx, lry))
+    size = (max(1, int(round(lrx*factor))), max(1, int(round(lry*factor))))
+    planes = []
+    for image in (highres, lowres):
+        if image.shape[:2] != size[::-1]:
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        if image.ndim == 3:
+            image = cv2.cvtColor(image[...,:3], cv2.COLOR_BGR2GRAY)
+        image = image.astype(np.float32)
+        planes.append((image, cv2.magnitude(cv2.Sobel(image, cv2.CV_32F, 1, 0), cv2.Sobel(image, cv2.CV_32F, 0, 1))))
+    (hr, hrgrad), (lr, lrgrad) = planes
+
+    dx, dy, response = phase_shifts(lr[None], hr[None])
+    metrics = {'shift': [float(dx[0]/factor), float(dy[0]/factor)], 'response': float(response[0]),
+               'gradient_ncc': float(batch_ncc(lrgrad[None], hrgrad[None])[0])}
+
+    worst = math.hypot(*metrics['shift'])
+    tiley, tilex = size[1]//SCORE_TILES, size[0]//SCORE_TILES
+    if tiley >= 16 and tilex >= 16:
+        tiles = lambda plane: plane[:tiley*SCORE_TILES,:tilex*SCORE_TILES].reshape(SCORE_TILES, tiley, SCORE_TILES, tilex).swapaxes(1, 2).reshape(-1, tiley, tilex)
+        dx, dy, response = phase_shifts(tiles(lr), tiles(hr))
+        shifts = np.hypot(dx, dy)/factor
+        textured = response >= SCORE_RESPONSE
+        if textured.any():
+            worst = float(shifts[textured].max())
+        metrics['tile_shift'] = [[round(float(shift), 3) if keep else None for shift, keep in zip(*row)]
+                                 for row in zip(shifts.reshape(SCORE_TILES, -1), textured.reshape(SCORE_TILES, -1))]
+        metrics['tile_ncc'] = batch_ncc(tiles(lrgrad), tiles(hrgrad)).astype(np.float64).reshape(SCORE_TILES, SCORE_TILES).round(3).tolist()
+
+    metrics['score'] = max(0, metrics['gradient_ncc'])*max(0, 1 - worst/SCORE_SHIFT)
+    return metrics
 
 def sort(file):
     with open(file, "r") as f:
@@ -487,122 +1578,898 @@ def sort(file):
     with open(file, "w") as f:
         f.writelines(sorted_lines)
 
+# Latest score record of every pair by name.  Records are appended as pairs finish, so the last one of a
+# pair is its newest.  A line cut short by a crash is ignored
+def read_scores():
+    scores = {}
+    if os.path.exists(SCORES):
+        with open(SCORES) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                scores.pop(record['name'], None)
+                scores[record['name']] = record
+    return scores
+
+# Rewrite the score file with only the latest record of every pair, in the order they were last scored
+def compact_scores():
+    with open(SCORES+'.tmp', 'w') as f:
+        for record in read_scores().values():
+            f.write(json.dumps(record) +'\n')
+    os.replace(SCORES+'.tmp', SCORES)
 
 
-def Do_Work(hrimg, lrimg, base = None):
 
-    highres = cv2.imread(hrimg, cv2.IMREAD_COLOR)
-    lowres = cv2.imread(lrimg, cv2.IMREAD_COLOR)
+def Do_Work(hrimg, lrimg, base = None):
 
+    (highres, lowres, keys), decoded = timed('decode', load_pair, hrimg, lrimg)
+    _, outputs, info = align_pair(base, highres, lowres, keys)
+    _, encoded = timed('encode', save_outputs, base, outputs)
+    profile_pair(base, decoded + info.pop('profile', []) + encoded)
+    return info
+
+# Read an image file, memory mapping raw .npy arrays so warps only page in the windows they read
+def read_image(path, flags=cv2.IMREAD_COLOR):
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return cv2.imread(path, flags)
+
+# Decode an image pair and work out its feature cache keys
+def load_pair(hrimg, lrimg):
+
+    highres = read_image(hrimg)
+    lowres = read_image(lrimg)
+    if highres is None or lowres is None:
+        raise ValueError('Could not read image pair')
+
+    keys = None
+    if cachedir:
+        keys = [image_key(hrimg, 'gray:blur13'), image_key(lrimg, 'gray')]
+
+    return highres, lowres, keys
+
+# Save output images in the selected format
+def write_image(folder, base, image):
+    path = 'Output/{:s}/{:s}.{:s}'.format(folder, base, output_format)
+    if output_format == 'npy':
+        np.save(path, image)
+    elif output_format == 'webp':
+        cv2.imwrite(path, image, [cv2.IMWRITE_WEBP_QUALITY, 101])
+    elif compression is not None:
+        cv2.imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    else:
+        cv2.imwrite(path, image)
+
+def save_outputs(base, outputs):
+    for folder, image in outputs:
+        write_image(folder, base, image)
+
+# Sidecar with everything needed to render a pair again without matching
+def transform_record(info):
+    record = {'mode': mode, 'scale': scale}
+    for field in ('kind', 'transform', 'points', 'crop', 'autocrop'):
+        if field in info:
+            record[field] = info[field]
+    return record
+
+# Render a pair from a saved transform, with any number of channels or bit depth
+def apply_pair(base, highres, lowres, record):
+    start = time.perf_counter()
+    profile_begin()
+    if 'autocrop' in record:
+        hrcrop, lrcrop = record['autocrop']
+        highres = highres[hrcrop[0]:hrcrop[1],hrcrop[2]:hrcrop[3]]
+        lowres = lowres[lrcrop[0]:lrcrop[1],lrcrop[2]:lrcrop[3]]
+
+    if record['kind'] == 'tps':
+        transform = tuple(np.float32(p).reshape(-1,1,2) for p in record['points'])
+    else:
+        transform = np.array(record['transform'])
+    top, left, bottom, right = record['crop']
+    top_left, bottom_right = np.array([top, left]), np.array([bottom, right])
+
+    # Several scales render each of them from the saved transform, which is at the saved scale.  A mode 1 crop
+    # saved for other scales is snapped again for these
+    if len(scales) > 1 and record['mode'] != mode:
+        raise ValueError('Saved transform is for mode {:d}'.format(record['mode']))
+    if len(scales) > 1 and mode == 1:
+        snap_crop(top_left, bottom_right)
+    outputs = []
+    for folder, factor in zip(scale_folders, scales if len(scales) > 1 else [record['scale']]):
+        scaled = transform if record['kind'] == 'tps' else rescale(transform, factor/record['scale'])
+        native = factor == record['scale']
+        if record['mode'] == 0:
+            hr, lr = Render_Aligned(highres, lowres, record['kind'], scaled, top_left, bottom_right, factor, interp, native)
+        else:
+            lr, hr = Render_Aligned(lowres, highres, record['kind'], scaled, top_left, bottom_right, factor, interp, native)
+        outputs += [(folder+'HR', hr), (folder+'LR', lr)]
+
+    events = profile_end()
+    return time.perf_counter() - start, outputs, {'profile': events} if profile else {}
+
+def load_apply(hrimg, lrimg, sidecar):
+    highres = read_image(hrimg, cv2.IMREAD_UNCHANGED)
+    lowres = read_image(lrimg, cv2.IMREAD_UNCHANGED)
+    if highres is None or lowres is None:
+        raise ValueError('Could not read image pair')
+    with open(sidecar) as f:
+        record = json.load(f)
+    return highres, lowres, record
+
+# Pipeline jobs rendering folder pairs from the sidecars in the --apply folder
+def apply_jobs(pair_list):
+    for hrim, lrim, base, name in pair_list:
+        sidecar = os.path.join(apply, base+'.json')
+        if not os.path.exists(sidecar):
+            print('No saved transform for ', name)
+            continue
+        yield name, base, functools.partial(load_apply, hrim, lrim, sidecar), functools.partial(pair_footprint, hrim, lrim), None
+
+# Prepare a decoded pair for alignment in one place: autocrop bounds from row and column maxima with the
+# crops as views, and the matching references as uint8 grayscale with HR blurred, a third of the size of
+# colour copies.  Manual mode keeps colour references to show
+def preprocess(highres, lowres, info):
     if autocrop:
-        highres = AutoCrop(highres)
-        lowres = AutoCrop(lowres)
+        bounds = []
+        with stage('autocrop'):
+            highres = AutoCrop(highres, bounds)
+            lowres = AutoCrop(lowres, bounds)
+        info['autocrop'] = bounds
+
+    with stage('blur'):
+        if Manual:
+            return highres, lowres, cv2.GaussianBlur(highres,(13,13),0), lowres
+        return highres, lowres, cv2.GaussianBlur(grayscale(highres),(13,13),0), grayscale(lowres)
+
+# Measured and output transforms of the previous pair in sequence mode
+sequence_prior = None
+sequence_shown = None
+
+# Align and score one decoded pair, returns the output images by folder and what the alignment found
+def Process_Pair(highres, lowres, base, keys=None):
+    global sequence_prior, sequence_shown
+
+    info = {}
+
+    highres, lowres, hrref, lrref = preprocess(highres, lowres, info)
+    if keys:
+        info['keys'] = keys if mode == 0 else keys[::-1]
+    if sequence:
+        info['prior'], info['shown'] = sequence_prior, sequence_shown
+        sequence_prior = sequence_shown = None
 
     if mode == 0:
-        highres, lowres = Align_Process(highres, lowres, cv2.GaussianBlur(highres,(13,13),0), lowres)
+        renders = Align_Process(highres, lowres, hrref, lrref, info)
 
     if mode == 1:
-        lowres, highres = Align_Process(lowres, highres, lowres, cv2.GaussianBlur(highres,(13,13),0))
+        renders = [(highres, lowres) for lowres, highres in Align_Process(lowres, highres, lrref, hrref, info)]
 
-    cv2.imwrite('Output/HR/{:s}.png'.format(base), highres)
-    cv2.imwrite('Output/LR/{:s}.png'.format(base), lowres)
+    if sequence:
+        sequence_prior, sequence_shown = info.get('measured', info.get('h')), info.get('h')
 
+    outputs = []
+    for folder, (highres, lowres) in zip(scale_folders, renders):
+        outputs += [(folder+'HR', highres), (folder+'LR', lowres)]
 
-    if Overlay:
+        if Overlay:
 
-        hhr, whr, _ = highres.shape
-        dim_overlay = (whr, hhr)
-        # scalelr = cv2.resize(lowres,dim_overlay, interpolation=cv2.INTER_LANCZOS4)
-        scalelr = bicubic_resize_bc(lowres,dim_overlay)
-        overlay = cv2.addWeighted(highres,0.5,scalelr,0.5,0)
-        cv2.imwrite('Output/Overlay/{:s}.png'.format(base), overlay)
+            hhr, whr, _ = highres.shape
+            dim_overlay = (whr, hhr)
+            # scalelr = cv2.resize(lowres,dim_overlay, interpolation=cv2.INTER_LANCZOS4)
+            scalelr = bicubic_resize_bc(lowres,dim_overlay)
+            overlay = cv2.addWeighted(highres,0.5,scalelr,0.5,0)
+            outputs.append((folder+'Overlay', overlay))
 
+    # The score is of the first scale, all scales share the transform
     if score:
-        try:
-            ascore = align_score(lowres, highres)
-        except:
-            ascore = 0
-        print('{:s}'.format(base)+' score: '+str(ascore))
-        with open('Output/AlignmentScore.txt', 'a+') as f:
-            f.write('{:s}'.format(base)+'   '+ str(ascore) +'\n')
-            f.close()
-
-
-if not os.path.exists('Output'):
-    os.mkdir('Output')
-if not os.path.exists('Output/LR'):
-    os.mkdir('Output/LR')
-if not os.path.exists('Output/HR'):
-    os.mkdir('Output/HR')
-if Overlay:
-    if not os.path.exists('Output/Overlay'):
-        os.mkdir('Output/Overlay')
-
-if mode == 1:
-    scale = 1/scale
-
-# Single image pair execution
-if os.path.isfile(HRfolder):
-    base = os.path.splitext(os.path.basename(HRfolder))[0]
-    hrim = HRfolder
-    lrim = LRfolder
-    Do_Work(hrim, lrim, base)
-
-elif threads > 1:
-
+        info['metrics'] = alignment_metrics(*renders[0])
+
+    return outputs, info
+
+# Print how a pair was aligned and write its transform sidecar and score record
+def report_pair(base, info):
+    if info.get('tracked'):
+        print('{:s}'.format(base)+' reused the previous transform')
+    if info.get('phase'):
+        print('{:s}'.format(base)+' aligned by phase correlation')
+    if 'levels' in info:
+        print('{:s}'.format(base)+' inliers per level: '+' '.join(str(n) for n in info['levels']))
+
+    if export:
+        with open('Output/Transforms/{:s}.json'.format(base), 'w') as f:
+            json.dump(transform_record(info), f)
+
+    if 'metrics' in info:
+        metrics = dict(info['metrics'])
+        record = {'name': base, 'score': round(metrics.pop('score'), 4)}
+        record.update(info.get('fit', {}))
+        record.update(metrics)
+        print('{:s}'.format(base)+' score: '+str(record['score']))
+        with open(SCORES, 'a') as f:
+            f.write(json.dumps(record) +'\n')
+
+
+# HR and LR folders, the HR and LR folders in the working directory when not given
+def pair_folders():
     if len(HRfolder) == 0:
-        HRfolder = 'HR'
-        LRfolder = 'LR/'
+        return 'HR', 'LR/'
+    return HRfolder, LRfolder
 
-    # Create multithreading function
-    def multi(path):
-        base = os.path.splitext(os.path.basename(path))[0]
-        extention = os.path.splitext(os.path.basename(path))[1]
-        hrim = path
-        lrim = LRfolder+'/'+base+extention
-        print('{:s}'.format(base)+extention)
-        try:
-            Do_Work(hrim,lrim,base)
-        except:
-            with open('Output/Failed.txt', 'a+') as f:
-                f.write('{:s}'.format(base)+extention+'\n')
-                f.close()
-            print('Match failed for ','{:s}'.format(base)+extention)
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = [executor.submit(multi,path)for path in glob.glob(HRfolder+'/*')]
-        try:
-            for future in as_completed(futures):
-                future.result()
-        except KeyboardInterrupt:
-            for future in futures:
-                future.cancel()
-            if os.path.exists('Output/Failed.txt'):
-                sort('Output/Failed.txt')
-            if score:
-                sort('Output/AlignmentScore.txt')
-
-# Single threaded execution
-else:
-    if len(HRfolder) == 0:
-        HRfolder = 'HR'
-        LRfolder = 'LR/'
-    for path in glob.glob(HRfolder+'/*'):
+# List HR/LR image pairs with matching file names
+def pairs():
+    hrfolder, lrfolder = pair_folders()
+    for path in sorted(glob.glob(hrfolder+'/*')):
         base = os.path.splitext(os.path.basename(path))[0]
         extention = os.path.splitext(os.path.basename(path))[1]
-        hrim = path
-        lrim = LRfolder+'/'+base+extention
-        print('{:s}'.format(base)+extention)
-        try:
-            Do_Work(hrim, lrim, base)
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            with open('Output/Failed.txt', 'a+') as f:
-                f.write('{:s}'.format(base)+extention+'\n')
-                f.close()
-            print('Match failed for ','{:s}'.format(base)+extention, traceback.format_exc())
-
-if os.path.exists('Output/Failed.txt'):
-    sort('Output/Failed.txt')
-if score:
-    sort('Output/AlignmentScore.txt')
+        yield path, lrfolder+'/'+base+extention, base, base+extention
+
+# The pair of a file name, as pairs() gives it
+def named_pair(name):
+    hrfolder, lrfolder = pair_folders()
+    return hrfolder+'/'+name, lrfolder+'/'+name, os.path.splitext(name)[0], name
+
+# Global descriptor of an image for content pairing, a small grayscale thumbnail of the autocropped image with
+# zero mean and unit length, so the dot product of two is their normalized cross correlation.  Images are
+# decoded at a quarter size where the format allows
+def thumbnail_descriptor(path):
+    if path.lower().endswith('.npy'):
+        image = read_image(path)
+        image = image[::4,::4]
+    else:
+        image = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if image is None or image.size == 0:
+        return None
+    image = grayscale(np.ascontiguousarray(image[...,:3]) if image.ndim == 3 else image)
+    if autocrop:
+        image = AutoCrop(image)
+    thumb = cv2.resize(image, (PAIR_THUMB, PAIR_THUMB), interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+    thumb -= thumb.mean()
+    norm = np.linalg.norm(thumb)
+    return thumb/norm if norm > 0 else thumb
+
+# Descriptors of image files by path.  Descriptors saved in the index are reused while the file and the
+# autocrop settings are unchanged, the rest are made on the decoder threads and saved back
+def descriptor_index(paths):
+    saved = {}
+    if os.path.exists(PAIR_INDEX):
+        with np.load(PAIR_INDEX) as index:
+            if int(index['autocrop']) == (lumthresh if autocrop else -1):
+                for path, prints, descriptor in zip(index['paths'], index['prints'], index['descriptors']):
+                    saved[str(path)] = (prints.tolist(), descriptor)
+
+    descriptors, missing = {}, []
+    for path in paths:
+        prints = fingerprint(path)
+        if path in saved and saved[path][0] == prints:
+            descriptors[path] = saved[path][1]
+        else:
+            missing.append(path)
+    with ThreadPoolExecutor(max_workers=decoders) as pool:
+        for path, descriptor in zip(missing, pool.map(thumbnail_descriptor, missing)):
+            if descriptor is not None:
+                descriptors[path] = descriptor
+
+    if missing and descriptors:
+        known = list(descriptors)
+        np.savez(PAIR_INDEX, autocrop=lumthresh if autocrop else -1, paths=np.array(known),
+                 prints=np.array([fingerprint(path) for path in known], np.int64), descriptors=np.stack([descriptors[path] for path in known]))
+    return descriptors
+
+# List HR/LR image pairs by content.  Every HR image is matched against all LR thumbnails in blocks, and
+# paired with the most similar one when it is similar enough.  The ranked candidates, margin over the runner
+# up and any LR image picked for more than one HR image are written to Output/Pairing.jsonl
+def content_pairs():
+    hrfolder, lrfolder = pair_folders()
+    hrpaths = sorted(glob.glob(hrfolder+'/*'))
+    lrpaths = sorted(glob.glob(lrfolder+'/*'))
+    descriptors = descriptor_index(hrpaths + lrpaths)
+    lrpaths = [path for path in lrpaths if path in descriptors]
+    if not lrpaths:
+        return
+    lrdescriptors = np.stack([descriptors[path] for path in lrpaths])
+
+    ranked = []
+    for path in hrpaths:
+        if path not in descriptors:
+            failed(os.path.basename(path))
+            print('Could not read ', path)
+    hrpaths = [path for path in hrpaths if path in descriptors]
+    count = min(PAIR_CANDIDATES, len(lrpaths))
+    for start in range(0, len(hrpaths), MATCH_BLOCK):
+        block = hrpaths[start:start+MATCH_BLOCK]
+        similarity = np.stack([descriptors[path] for path in block]) @ lrdescriptors.T
+        top = np.argpartition(-similarity, count - 1, axis=1)[:,:count]
+        for row, path in enumerate(block):
+            order = top[row][np.argsort(-similarity[row, top[row]])]
+            ranked.append((path, [(lrpaths[i], float(similarity[row, i])) for i in order]))
+
+    picks = {}
+    for path, candidates in ranked:
+        if candidates[0][1] >= PAIR_SIMILARITY:
+            picks[candidates[0][0]] = picks.get(candidates[0][0], 0) + 1
+
+    unsure = unpaired = 0
+    with open('Output/Pairing.jsonl', 'w') as f:
+        for path, candidates in ranked:
+            name = os.path.basename(path)
+            best, similarity = candidates[0]
+            margin = similarity - candidates[1][1] if len(candidates) > 1 else similarity
+            record = {'name': name, 'lr': os.path.basename(best), 'similarity': round(similarity, 4), 'margin': round(margin, 4),
+                      'shared': picks.get(best, 0) > 1, 'candidates': [[os.path.basename(lr), round(value, 4)] for lr, value in candidates]}
+            record['confident'] = similarity >= PAIR_SIMILARITY and margin >= PAIR_MARGIN and not record['shared']
+            f.write(json.dumps(record)+'\n')
+            if similarity < PAIR_SIMILARITY:
+                unpaired += 1
+                continue
+            unsure += not record['confident']
+
+    print('Paired {:d} HR images by content, {:d} unsure, {:d} without a match (see Output/Pairing.jsonl)'.format(len(ranked) - unpaired, unsure, unpaired))
+    for path, candidates in ranked:
+        name = os.path.basename(path)
+        if candidates[0][1] < PAIR_SIMILARITY:
+            failed(name)
+            continue
+        yield path, candidates[0][0], os.path.splitext(name)[0], name
+
+# Width and height of an image from its header, with Pillow's decompression bomb limit lifted as the largest
+# images are the ones the estimate matters most for
+def image_size(path):
+    if path.lower().endswith('.npy'):
+        return np.load(path, mmap_mode='r').shape[1::-1]
+    import PIL.Image
+    limit = PIL.Image.MAX_IMAGE_PIXELS
+    PIL.Image.MAX_IMAGE_PIXELS = None
+    try:
+        with PIL.Image.open(path) as image:
+            return image.size
+    finally:
+        PIL.Image.MAX_IMAGE_PIXELS = limit
+
+# Estimate the peak memory of a pair in bytes from the image headers without decoding them.  A pair whose
+# size can't be read counts as larger than the budget, so it runs on its own
+def pair_footprint(hrim, lrim):
+    try:
+        (hrx, hry), (lrx, lry) = image_size(hrim), image_size(lrim)
+    except Exception:
+        return memory + 1
+    # Decoded BGR copies of both images plus the upscaled BGR and gray matching canvases, and the outputs of
+    # any extra scales
+    return 3*(hrx*hry + lrx*lry)*WORKING_COPIES + 8*max(hrx,lrx)*max(hry,lry) + 3*hrx*hry*(len(scales) - 1)
+
+# Align stage of the pipeline, run on a worker process when there is more than one.  Returns the wall time
+# of the alignment, the output images and what the alignment found
+def align_pair(base, highres, lowres, keys=None):
+    start = time.perf_counter()
+    profile_begin()
+    try:
+        outputs, info = Process_Pair(highres, lowres, base, keys)
+        report_pair(base, info)
+    finally:
+        events = profile_end()
+    if profile:
+        info['profile'] = events
+    return time.perf_counter() - start, outputs, info
+
+# Open a video with an installed VapourSynth source plugin as 8 bit RGB
+def open_video(path):
+    import vapoursynth as vs
+    core = vs.core
+    if hasattr(core, 'lsmas'):
+        clip = core.lsmas.LWLibavSource(path)
+    elif hasattr(core, 'ffms2'):
+        clip = core.ffms2.Source(path)
+    else:
+        raise RuntimeError('Video input needs the L-SMASH Works or FFMS2 VapourSynth plugin')
+    if clip.format.color_family == vs.RGB:
+        return core.resize.Point(clip, format=vs.RGB24)
+    return core.resize.Bicubic(clip, format=vs.RGB24, matrix_in_s='709' if clip.height > 576 else '170m')
+
+def video_frame(clip, n):
+    frame = clip.get_frame(n)
+    return cv2.merge([np.array(frame[i], copy=True) for i in reversed(range(frame.format.num_planes))])
+
+# Small gray copy of a clip with per frame brightness and difference to the previous frame attached
+def video_stats(clip):
+    import vapoursynth as vs
+    core = vs.core
+    small = core.resize.Bilinear(clip, VIDEO_THUMB, VIDEO_THUMB, format=vs.GRAY8, matrix_s='709')
+    return core.std.PlaneStats(small, small[0] + small[:-1])
+
+# Frames of the HR clip to align, every Nth frame or a few frames into every scene
+def video_samples(clip):
+    if not scenes:
+        return list(range(0, clip.num_frames, every))
+    samples = [0]
+    for n, frame in enumerate(video_stats(clip).frames()):
+        if n and frame.props['PlaneStatsDiff'] > SCENE_THRESHOLD and n - samples[-1] >= every:
+            samples.append(n)
+    return [min(n + SCENE_SKIP, clip.num_frames - 1) if n else n for n in samples]
+
+# Frame offset of the LR clip against the HR clip.  Compares the brightness changes from frame to frame
+# over a window in the middle of both clips, which doesn't depend on cropping or scale
+def video_offset(hrclip, lrclip):
+    if sync == 0:
+        return 0
+    window = min(SYNC_WINDOW, hrclip.num_frames)
+    start = max(0, hrclip.num_frames//2 - window//2)
+    lo, hi = max(0, start - sync), min(lrclip.num_frames, start + window + sync)
+    hr = np.diff([f.props['PlaneStatsAverage'] for f in video_stats(hrclip[start:start+window]).frames()])
+    lr = np.diff([f.props['PlaneStatsAverage'] for f in video_stats(lrclip[lo:hi]).frames()])
+    hr = hr - hr.mean()
+
+    best, offset = -np.inf, 0
+    for shift in range(-sync, sync + 1):
+        first = start + shift - lo
+        if first < 0 or first + len(hr) > len(lr):
+            continue
+        segment = lr[first:first+len(hr)] - lr[first:first+len(hr)].mean()
+        corr = np.dot(hr, segment)/(np.linalg.norm(hr)*np.linalg.norm(segment) + 1e-12)
+        if corr > best:
+            best, offset = corr, shift
+    print('LR frame offset {:d} (correlation {:.3f})'.format(offset, best))
+    return offset
+
+def load_frames(hrclip, lrclip, hrn, lrn):
+    return video_frame(hrclip, hrn), video_frame(lrclip, lrn), None
+
+# Align frames sampled from two encodes of the same video without extracting them to image files first
+def video_jobs(hrvideo, lrvideo):
+    hrclip, lrclip = open_video(hrvideo), open_video(lrvideo)
+    offset = video_offset(hrclip, lrclip)
+    name = os.path.splitext(os.path.basename(hrvideo))[0]
+    frames = [(n, n + offset) for n in video_samples(hrclip) if 0 <= n + offset < lrclip.num_frames]
+    print('Aligning {:d} frames'.format(len(frames)))
+
+    size = 3*(hrclip.width*hrclip.height + lrclip.width*lrclip.height)*WORKING_COPIES + 8*max(hrclip.width,lrclip.width)*max(hrclip.height,lrclip.height)
+    for hrn, lrn in frames:
+        base = '{:s}_{:06d}'.format(name, hrn)
+        yield base, base, functools.partial(load_frames, hrclip, lrclip, hrn, lrn), lambda: size, None
+
+def failed(name):
+    with open('Output/Failed.txt', 'a+') as f:
+        f.write(name+'\n')
+
+# Hash of the settings that change the output images, so a resumed run redoes pairs aligned differently
+def run_params():
+    ignore = ('threads', 'memory', 'decoders', 'encoders', 'hr', 'lr', 'cache', 'cachesize', 'resume', 'export', 'tile', 'profile', 'watch', 'interval', 'review')
+    settings = json.dumps({k: v for k, v in sorted(args.items()) if k not in ignore})
+    return hashlib.blake2b(settings.encode(), digest_size=8).hexdigest()
+
+def fingerprint(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+# Last manifest record of every pair.  A line cut short by a crash is ignored
+def load_manifest():
+    records = {}
+    if os.path.exists(MANIFEST):
+        with open(MANIFEST) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['name']] = record
+    return records
+
+# Append the outcome of a pair to the manifest
+def record_pair(name, hrim, lrim, status, info=None):
+    record = {'name': name, 'hr': fingerprint(hrim), 'lr': fingerprint(lrim), 'params': run_params(), 'status': status}
+    if info:
+        for field in ('kind', 'transform', 'points', 'crop', 'autocrop', 'reviewed'):
+            if field in info:
+                record[field] = info[field]
+    with open(MANIFEST, 'a') as f:
+        f.write(json.dumps(record)+'\n')
+
+# Drop pairs the manifest has as done with the same inputs and settings
+def unfinished(pair_list):
+    records = load_manifest()
+    params = run_params()
+    skipped = 0
+    for hrim, lrim, base, name in pair_list:
+        record = records.get(name)
+        if (record and record['status'] == 'done' and record['params'] == params
+                and record['hr'] == fingerprint(hrim) and record['lr'] == fingerprint(lrim)):
+            skipped += 1
+            continue
+        yield hrim, lrim, base, name
+    if skipped:
+        print('Skipped {:d} completed pairs'.format(skipped))
+
+# Whether the manifest has a pair as corrected in review with the same inputs and settings
+def corrected(record, hrim, lrim):
+    return (record is not None and record.get('reviewed') and record['status'] == 'done' and record['params'] == run_params()
+            and record['hr'] == fingerprint(hrim) and record['lr'] == fingerprint(lrim))
+
+# Pairs to review after an automatic run, those that failed or whose latest score is under the review
+# threshold, lowest score first.  The queue is written to Output/ReviewQueue.jsonl
+def review_queue(pair_list):
+    scores = read_scores()
+    records = load_manifest()
+
+    queue = []
+    for hrim, lrim, base, name in pair_list:
+        record = records.get(name)
+        if record is None or corrected(record, hrim, lrim):
+            continue
+        if record['status'] == 'failed':
+            queue.append(({'name': name, 'status': 'failed'}, (hrim, lrim, base, name)))
+        elif base in scores and scores[base]['score'] < review:
+            fit = {field: scores[base][field] for field in ('score', 'inliers', 'residual') if field in scores[base]}
+            queue.append((dict(name=name, status='low score', **fit), (hrim, lrim, base, name)))
+    queue.sort(key=lambda item: (item[0].get('score', -1), item[0].get('inliers', 0)))
+
+    with open('Output/ReviewQueue.jsonl', 'w') as f:
+        for entry, _ in queue:
+            f.write(json.dumps(entry)+'\n')
+    print('{:d} of {:d} pairs need review (see Output/ReviewQueue.jsonl)'.format(len(queue), len(pair_list)))
+    return [pair for _, pair in queue]
+
+# Open the manual windows for every queued pair in turn, each starting from its automatic points.  Once they
+# are closed the corrected transform is saved to Output/Reviewed and the pair is rendered and recorded again.  Closing
+# with Ctrl+C stops the review, the pairs left stay queued for the next run
+def review_pairs(queue):
+    global Manual
+    manual_ui()
+    Manual = True
+    try:
+        for position, (hrim, lrim, base, name) in enumerate(queue):
+            print('Review {:d}/{:d}: {:s}'.format(position + 1, len(queue), name))
+            try:
+                highres, lowres, keys = load_pair(hrim, lrim)
+                _, outputs, info = align_pair(base, highres, lowres, keys)
+            except KeyboardInterrupt:
+                print('Review stopped, {:d} pairs left'.format(len(queue) - position))
+                return
+            except Exception:
+                print('Review failed for ', name)
+                print(traceback.format_exc())
+                continue
+            # Only pairs whose points were shown and closed by hand count as reviewed
+            if not info.get('reviewed'):
+                print('Review skipped for ', name)
+                continue
+            save_outputs(base, outputs)
+            with open('Output/Reviewed/{:s}.json'.format(base), 'w') as f:
+                json.dump(transform_record(info), f)
+            record_pair(name, hrim, lrim, 'done', info)
+    finally:
+        Manual = False
+
+# Pipeline jobs for folder pairs: name, output base name, decode function, memory estimate function and the
+# input files recorded in the manifest
+def folder_jobs(pair_list):
+    for hrim, lrim, base, name in pair_list:
+        yield name, base, functools.partial(load_pair, hrim, lrim), functools.partial(pair_footprint, hrim, lrim), (hrim, lrim)
+
+# Thread and process pools of the pipeline stages.  Watch mode keeps one set for the whole session, so the
+# workers keep their matchers and resampling tables between pairs
+def make_pools():
+    return (ThreadPoolExecutor(max_workers=decoders), ThreadPoolExecutor(max_workers=encoders),
+            ProcessPoolExecutor(max_workers=threads, initializer=configure, initargs=(args,)) if threads > 1 else None)
+
+# Run jobs through decode, align and encode stages so decoding and image encoding overlap the alignment.
+# Decoding and encoding run on threads, alignment on worker processes, or in this process with one thread.
+# Stages are bounded so decoded pairs wait for a worker and finished pairs wait for an encoder, and the
+# estimated memory of all pairs in the pipeline is kept under the budget
+def run_pipeline(jobs, work=align_pair, pools=None, progress=None):
+    jobs = deque(jobs)
+    ready = deque()
+    decoding, aligning, encoding = {}, {}, {}
+    in_flight = 0
+    size = None
+    events = {}
+
+    decoder, encoder, aligner = pools or make_pools()
+
+    def fail(job, step):
+        nonlocal in_flight
+        name, base, load, estimate, files, footprint = job
+        in_flight -= footprint
+        events.pop(name, None)
+        failed(name)
+        if files:
+            record_pair(name, files[0], files[1], 'failed')
+        print('Match failed for ', name, '({:s})'.format(step))
+        if progress:
+            progress(name, 'failed')
+
+    def encode(job, result):
+        elapsed, outputs, info = result
+        events[job[0]] += info.pop('profile', [])
+        encoding[encoder.submit(timed, 'encode', save_outputs, job[1], outputs)] = (job, elapsed, info)
+
+    try:
+        while jobs or ready or decoding or aligning or encoding:
+
+            # Decode ahead of the align stage
+            while jobs and len(decoding) + len(ready) < 2*decoders:
+                name, base, load, estimate, files = jobs[0]
+                if size is None:
+                    size = estimate() if memory else 0
+                # An oversized pair still runs, but only on its own
+                if memory and in_flight and in_flight + size > memory:
+                    break
+                jobs.popleft()
+                decoding[decoder.submit(timed, 'decode', load)] = (name, base, load, estimate, files, size)
+                in_flight += size
+                size = None
+
+            # Hand decoded pairs to the aligner while the encoders keep up
+            aligned_here = False
+            while ready and len(encoding) < 2*encoders and (aligner is None or len(aligning) < threads):
+                job, loaded = ready.popleft()
+                print(job[0])
+                if aligner is None:
+                    try:
+                        encode(job, work(job[1], *loaded))
+                    except Exception:
+                        fail(job, 'align')
+                        print(traceback.format_exc())
+                    aligned_here = True
+                    break
+                aligning[aligner.submit(work, job[1], *loaded)] = job
+
+            if not (decoding or aligning or encoding):
+                continue
+            done, _ = wait(list(decoding) + list(aligning) + list(encoding), timeout=0 if aligned_here else None, return_when=FIRST_COMPLETED)
+
+            # Decoded pairs are released in job order, which sequence mode relies on
+            while decoding and next(iter(decoding)).done():
+                future = next(iter(decoding))
+                job = decoding.pop(future)
+                try:
+                    loaded, events[job[0]] = future.result()
+                    ready.append((job, loaded))
+                except Exception:
+                    fail(job, 'decode')
+
+            for future in done:
+                if future in aligning:
+                    job = aligning.pop(future)
+                    try:
+                        encode(job, future.result())
+                    except Exception:
+                        fail(job, 'align')
+                elif future in encoding:
+                    job, elapsed, info = encoding.pop(future)
+                    try:
+                        _, encoded = future.result()
+                    except Exception:
+                        fail(job, 'encode')
+                        continue
+                    name, base, load, estimate, files, footprint = job
+                    in_flight -= footprint
+                    if files:
+                        record_pair(name, files[0], files[1], 'done', info)
+                    profile_pair(name, events.pop(name) + encoded)
+                    print('{:s} done in {:.2f}s'.format(name, elapsed))
+                    if progress:
+                        progress(name, 'done')
+
+    except KeyboardInterrupt:
+        return False
+    finally:
+        if pools is None:
+            for executor in (decoder, aligner, encoder):
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+    return True
+
+# Wake the watch loop on file system events when the watchdog package is installed, else it only polls.  The
+# names of the files the events touch are added to changed, moves by both their old and new names
+def watch_events(folders, wake, changed, lock):
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+
+    def on_any_event(event):
+        if not event.is_directory:
+            with lock:
+                for path in (event.src_path, getattr(event, 'dest_path', '')):
+                    if path:
+                        changed.add(os.path.basename(os.fsdecode(path)))
+        wake.set()
+
+    handler = FileSystemEventHandler()
+    handler.on_any_event = on_any_event
+    observer = Observer()
+    for folder in folders:
+        observer.schedule(handler, folder)
+    observer.start()
+    return observer
+
+# Stop watch mode cleanly when a service manager terminates it
+def stop_watch(signum, frame):
+    raise KeyboardInterrupt
+
+# Write the watch mode status file in one step so readers never see half of it
+def write_status(status):
+    with open(STATUS+'.tmp', 'w') as f:
+        json.dump(status, f, indent=1)
+    os.replace(STATUS+'.tmp', STATUS)
+
+# Watch mode.  Scans the folders for pairs with both files present, and queues a pair once its files have
+# stayed the same for WATCH_SETTLE seconds so half written files are never read.  With file system events only
+# the pairs they name and those still settling are checked, between full scans every WATCH_RESCAN seconds.
+# Pairs run through one pipeline whose pools stay alive for the session.  Pairs already done with the same
+# files and settings, in this session or an earlier one, are not redone
+def watch_folders():
+    folders = pair_folders()
+    params = run_params()
+    seen = {name: [record['hr'], record['lr']] for name, record in load_manifest().items() if record['status'] == 'done' and record['params'] == params}
+    changed = {}
+    finished = deque()
+    status = {'state': 'idle', 'watching': 'polling', 'queued': 0, 'waiting': 0, 'done': 0, 'failed': 0, 'pairs_per_s': 0,
+              'started': time.time(), 'updated': time.time()}
+
+    def progress(name, outcome):
+        status[outcome] += 1
+        status['queued'] -= 1
+        finished.append(time.time())
+        while finished and finished[0] < time.time() - WATCH_WINDOW:
+            finished.popleft()
+        status['pairs_per_s'] = round(len(finished)/min(WATCH_WINDOW, max(1e-9, time.time() - status['started'])), 4)
+        status['updated'] = time.time()
+        write_status(status)
+
+    signal.signal(signal.SIGTERM, stop_watch)
+    pools = make_pools()
+    wake = threading.Event()
+    touched, lock = set(), threading.Lock()
+    observer = watch_events(folders, wake, touched, lock)
+    if observer:
+        status['watching'] = 'events'
+    print('Watching {:s} and {:s}, Ctrl+C to stop'.format(*folders))
+    scanned = None
+    try:
+        while True:
+            now = time.time()
+            with lock:
+                names = touched | set(changed)
+                touched.clear()
+            if not observer or scanned is None or now - scanned >= WATCH_RESCAN:
+                checking, scanned = list(pairs()), now
+            else:
+                checking = [named_pair(name) for name in sorted(names)]
+            ready, waiting, present = [], 0, set()
+            for pair in checking:
+                name = pair[3]
+                prints = [fingerprint(pair[0]), fingerprint(pair[1])]
+                if None in prints or seen.get(name) == prints:
+                    continue
+                present.add(name)
+                if changed.get(name, (None,))[0] != prints:
+                    changed[name] = (prints, now)
+                if now - changed[name][1] >= WATCH_SETTLE:
+                    ready.append(pair)
+                    seen[name] = prints
+                    del changed[name]
+                else:
+                    waiting += 1
+            checked = {pair[3] for pair in checking}
+            changed = {name: entry for name, entry in changed.items() if name in present or name not in checked}
+
+            status.update(state='busy' if ready else 'idle', queued=len(ready), waiting=waiting, updated=now)
+            write_status(status)
+            if ready:
+                if not run_pipeline(folder_jobs(ready), pools=pools, progress=progress):
+                    break
+                status.update(state='idle', queued=0, updated=time.time())
+                write_status(status)
+                continue
+
+            wake.wait(min(interval, WATCH_SETTLE) if waiting else interval)
+            wake.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer:
+            observer.stop()
+        for executor in pools:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        status.update(state='stopped', updated=time.time())
+        write_status(status)
+
+
+# Aligns image pairs in memory for use as a library.  Options are the command line ones by their long names,
+# for example Aligner(2, mode=0, autocrop=True, pyramid=True, overlay=False).  Settings are module wide
+# while a pair is aligned, so use an Aligner from one thread at a time
+class Aligner:
+    def __init__(self, scale, mode=0, **options):
+        self.options = default_options()
+        unknown = set(options) - set(self.options)
+        if unknown:
+            raise TypeError('Unknown options: '+', '.join(sorted(unknown)))
+        self.options.update(options, scale=scale, mode=mode)
+        configure(self.options)
+
+    # Align a pair of BGR images.  Returns a dict with the aligned 'hr' and 'lr' images, 'overlay' when
+    # enabled, under 'x2/hr' and so on with several scales, the transform record that --apply renders from ('kind', 'transform' or 'points', 'crop',
+    # 'autocrop'), the match 'fit' and the 'metrics' when score is enabled
+    def align_pair(self, hr, lr, name='pair'):
+        configure(self.options)
+        outputs, info = Process_Pair(hr, lr, name)
+        result = {folder.lower(): image for folder, image in outputs}
+        result.update(transform_record(info))
+        for field in ('fit', 'metrics', 'levels', 'phase', 'tracked'):
+            if field in info:
+                result[field] = info[field]
+        return result
+
+    # Render a pair of images of any depth and channels from a transform record of align_pair or --export
+    def render(self, hr, lr, record):
+        configure(self.options)
+        _, outputs, _ = apply_pair('pair', hr, lr, record)
+        return {folder.lower(): image for folder, image in outputs}
+
+# Command line entry point
+def main(argv=None):
+    configure(vars(parser.parse_args(argv)))
+
+    for folder in scale_folders:
+        os.makedirs('Output/'+folder+'LR', exist_ok=True)
+        os.makedirs('Output/'+folder+'HR', exist_ok=True)
+        if Overlay:
+            os.makedirs('Output/'+folder+'Overlay', exist_ok=True)
+    if export:
+        if not os.path.exists('Output/Transforms'):
+            os.mkdir('Output/Transforms')
+    if review is not None:
+        if not os.path.exists('Output/Reviewed'):
+            os.mkdir('Output/Reviewed')
+
+    if profile:
+        profile_open()
+
+    # Video pair execution
+    if video:
+        run_pipeline(video_jobs(HRfolder, LRfolder))
+
+    # Single image pair execution
+    elif os.path.isfile(HRfolder):
+        base = os.path.splitext(os.path.basename(HRfolder))[0]
+        hrim = HRfolder
+        lrim = LRfolder
+        Do_Work(hrim, lrim, base)
+
+    # Align pairs as they arrive
+    elif watch:
+        watch_folders()
+
+    # Render folder pairs from saved transforms
+    elif apply:
+        run_pipeline(apply_jobs(content_pairs() if pairing else pairs()), apply_pair)
+
+    # Align folder pairs automatically, then correct the worst of them by hand
+    elif review is not None:
+        pair_list = list(content_pairs() if pairing else pairs())
+        records = load_manifest()
+        automatic = [pair for pair in pair_list if not corrected(records.get(pair[3]), pair[0], pair[1])]
+        if run_pipeline(folder_jobs(unfinished(automatic) if resume else automatic)):
+            review_pairs(review_queue(pair_list))
+
+    # Folder execution
+    else:
+        pair_list = content_pairs() if pairing else pairs()
+        run_pipeline(folder_jobs(unfinished(pair_list) if resume else pair_list))
+
+    profile_summary()
+
+    if os.path.exists('Output/Failed.txt'):
+        sort('Output/Failed.txt')
+    if score and os.path.exists(SCORES):
+        compact_scores()
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,305 @@
+import os
+import sys
+import cv2
+import glob
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import numpy as np
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="Benchmark ImgAlign on synthetic HR/LR pairs with known transforms.  Reports throughput, peak\nmemory and the error of the found transforms against the ground truth for each case.")
+parser.add_argument("--seeds", default='', help="Folder of seed images to make the pairs from.  Procedural textures are used when not given.")
+parser.add_argument("--pairs", default=4, help="Default 4.  Pairs generated per case.")
+parser.add_argument("--size", default=1600, help="Default 1600.  Width of the HR images, the height is 3/4 of it.")
+parser.add_argument("-s", "--scale", default=2, help="Default 2.  Nominal scale between HR and LR.")
+parser.add_argument("-n", "--threads", default=1, help="Default 1.  Passed on to ImgAlign.")
+parser.add_argument("--cases", default='scale,sift,rotate,perspective,autocrop,tps', help="Default all.  Comma separated cases to run:\nscale       scale and sub-pixel offset, default settings\nsift        the same pairs with feature matching only (--phase)\nrotate      small rotations with -r\nperspective perspective distortion with -f\nautocrop    black borders on both images with -c\ntps         smooth warps rendered from the true control points with --apply")
+parser.add_argument("--seed", default=0, help="Default 0.  Random seed of the generated pairs.")
+parser.add_argument("--out", default='Benchmark', help="Default Benchmark.  Working folder, results are saved to results.json in it.")
+parser.add_argument("--baseline", default='', help="results.json of an earlier run to compare against.")
+parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ImgAlign.py'), help="Default ImgAlign.py next to this script.  ImgAlign script to benchmark.")
+args = vars(parser.parse_args())
+
+scale = int(args["scale"])
+size = (int(args["size"]), int(args["size"])*3//4)
+
+# HR pixels kept clear around the LR frame so every LR pixel has HR content
+MARGIN = 64
+# Black border width range in pixels for the autocrop case
+BORDER = (4, 40)
+# Control points per side of the tps case and the largest displacement of its warp in LR pixels
+TPS_POINTS = 8
+TPS_AMPLITUDE = 1.5
+# Tiles per side the tps render is checked on
+CHECK_TILES = 4
+
+# Procedural seed image of overlapping shapes and lines on a mid grey ground, textured everywhere so the
+# images have no dark borders of their own
+def procedural_seed(rng):
+    width, height = size
+    image = np.full((height, width, 3), 128, np.uint8)
+    for _ in range(width*height//1500):
+        colour = tuple(int(c) for c in rng.integers(60, 256, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        shape = rng.integers(0, 3)
+        if shape == 0:
+            cv2.circle(image, (x, y), int(rng.integers(3, 40)), colour, -1)
+        elif shape == 1:
+            cv2.rectangle(image, (x, y), (x + int(rng.integers(4, 60)), y + int(rng.integers(4, 60))), colour, -1)
+        else:
+            cv2.line(image, (x, y), (int(rng.integers(0, width)), int(rng.integers(0, height))), colour, int(rng.integers(1, 4)))
+    return cv2.GaussianBlur(image, (3, 3), 0)
+
+# Seed images, cycling through the seed folder or making procedural ones
+def seed_images(rng, count):
+    files = sorted(glob.glob(os.path.join(args["seeds"], '*'))) if args["seeds"] else []
+    for index in range(count):
+        if files:
+            image = cv2.imread(files[index % len(files)], cv2.IMREAD_COLOR)
+            yield cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        else:
+            yield procedural_seed(rng)
+
+# Ground truth transform from HR to LR pixels for a case, and the LR image size.  The LR frame maps inside
+# the HR image less MARGIN so it is fully covered
+def ground_truth(rng, case):
+    width, height = size
+    lrscale = (1 + rng.uniform(-0.02, 0.02))/scale
+    lrsize = (int((width - 2*MARGIN)*lrscale), int((height - 2*MARGIN)*lrscale))
+    offset = rng.uniform(MARGIN/2, MARGIN, 2)
+    truth = np.array([[lrscale, 0, -lrscale*offset[0]], [0, lrscale, -lrscale*offset[1]], [0, 0, 1]])
+
+    # Rotations and perspective act around the centre of the LR frame
+    centre = np.array([[1, 0, lrsize[0]/2], [0, 1, lrsize[1]/2], [0, 0, 1]])
+    if case == 'rotate':
+        angle = np.radians(rng.uniform(-3, 3))
+        rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+        truth = centre @ rotation @ np.linalg.inv(centre) @ truth
+    elif case == 'perspective':
+        perspective = np.eye(3)
+        perspective[2,:2] = rng.uniform(-2e-5, 2e-5, 2)
+        truth = centre @ perspective @ np.linalg.inv(centre) @ truth
+    return truth, lrsize
+
+# Smooth displacement in LR pixels of the tps case, a few random sine waves over the frame
+def displacement(waves, x, y):
+    dx, dy = np.zeros_like(x), np.zeros_like(y)
+    for amplitude, fx, fy, phase in waves:
+        dx += amplitude[0]*np.sin(fx*x + fy*y + phase)
+        dy += amplitude[1]*np.cos(fy*x + fx*y + phase)
+    return dx, dy
+
+# HR source coordinates of LR positions in the tps case
+def tps_source(truth, waves, x, y):
+    dx, dy = displacement(waves, x, y)
+    inverse = np.linalg.inv(truth)
+    return inverse[0,0]*(x + dx) + inverse[0,2], inverse[1,1]*(y + dy) + inverse[1,2]
+
+# Black border of random width on each side
+def add_border(rng, image):
+    top, bottom, left, right = (int(n) for n in rng.integers(BORDER[0], BORDER[1], 4))
+    return cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0), (top, left)
+
+# Write the pairs of a case to HR and LR folders, returns the ground truth of every pair
+def generate(case, folder, rng):
+    for sub in ('HR', 'LR', 'Truth'):
+        os.makedirs(os.path.join(folder, sub), exist_ok=True)
+    truths = {}
+    for index, seed in enumerate(seed_images(rng, int(args["pairs"]))):
+        base = 'pair{:03d}'.format(index)
+        truth, lrsize = ground_truth(rng, case)
+        # Blur before sampling so LR is an antialiased downscale
+        blurred = cv2.GaussianBlur(seed, (0, 0), 0.5*scale)
+        record = {'truth': truth.tolist(), 'lrsize': lrsize}
+
+        if case == 'tps':
+            waves = [(rng.uniform(-1, 1, 2)*TPS_AMPLITUDE/2, rng.uniform(0.002, 0.01), rng.uniform(0.002, 0.01), rng.uniform(0, 2*np.pi)) for _ in range(2)]
+            xs, ys = np.meshgrid(np.arange(lrsize[0], dtype=np.float32), np.arange(lrsize[1], dtype=np.float32))
+            mapx, mapy = tps_source(truth, waves, xs, ys)
+            lowres = cv2.remap(blurred, mapx.astype(np.float32), mapy.astype(np.float32), cv2.INTER_LINEAR)
+
+            # The transform ImgAlign would have found, the true control points on a grid over the LR frame
+            gridx, gridy = np.meshgrid(np.linspace(0, lrsize[0] - 1, TPS_POINTS), np.linspace(0, lrsize[1] - 1, TPS_POINTS))
+            sourcex, sourcey = tps_source(truth, waves, gridx, gridy)
+            points1 = np.stack([sourcex.ravel(), sourcey.ravel()], 1)
+            points2 = np.stack([gridx.ravel(), gridy.ravel()], 1)
+            sidecar = {'mode': 0, 'scale': scale, 'kind': 'tps', 'points': [points1.tolist(), points2.tolist()], 'crop': [0, 0, lrsize[1] - 1, lrsize[0] - 1]}
+            os.makedirs(os.path.join(folder, 'Apply'), exist_ok=True)
+            with open(os.path.join(folder, 'Apply', base+'.json'), 'w') as f:
+                json.dump(sidecar, f)
+            record['waves'] = [(list(amplitude), fx, fy, phase) for amplitude, fx, fy, phase in waves]
+        elif case == 'perspective':
+            lowres = cv2.warpPerspective(blurred, truth, lrsize, flags=cv2.INTER_LINEAR)
+        else:
+            lowres = cv2.warpAffine(blurred, truth[:2], lrsize, flags=cv2.INTER_LINEAR)
+
+        highres = seed
+        if case == 'autocrop':
+            highres, record['hrpad'] = add_border(rng, highres)
+            lowres, record['lrpad'] = add_border(rng, lowres)
+
+        cv2.imwrite(os.path.join(folder, 'HR', base+'.png'), highres)
+        cv2.imwrite(os.path.join(folder, 'LR', base+'.png'), lowres)
+        with open(os.path.join(folder, 'Truth', base+'.json'), 'w') as f:
+            json.dump(record, f)
+        truths[base] = record
+    return truths
+
+# Translation as a 3x3 matrix
+def shift(x, y):
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], np.float64)
+
+# Ground truth in the convention ImgAlign works in, pixel indices scaled with no centre term.  The pairs are
+# made with OpenCV warps, which map pixel centres
+def renderer_truth(truth):
+    return shift(0.5, 0.5) @ truth @ shift(-0.5, -0.5)
+
+# Error in LR pixels of a found HR to LR transform on a grid over the LR frame, RMS and largest
+def transform_error(found, truth, lrsize):
+    gridx, gridy = np.meshgrid(np.linspace(0, lrsize[0] - 1, 9), np.linspace(0, lrsize[1] - 1, 9))
+    target = np.stack([gridx.ravel(), gridy.ravel(), np.ones(gridx.size)])
+    source = np.linalg.inv(truth) @ target
+    mapped = found @ (source/source[2])
+    error = np.linalg.norm(mapped[:2]/mapped[2] - target[:2], axis=0)
+    return float(np.sqrt(np.mean(error**2))), float(error.max())
+
+# Found transform of a pair from its exported sidecar, as a 3x3 matrix between the uncropped images
+def found_transform(record, truth):
+    found = np.array(record['transform'])
+    if found.shape[0] == 2:
+        found = np.vstack([found, [0, 0, 1]])
+    found = np.diag([1/record['scale'], 1/record['scale'], 1]) @ found
+    if 'autocrop' in record:
+        hrcrop, lrcrop = record['autocrop']
+        found = shift(lrcrop[2] - truth['lrpad'][1], lrcrop[0] - truth['lrpad'][0]) @ found @ shift(truth['hrpad'][1] - hrcrop[2], truth['hrpad'][0] - hrcrop[0])
+    return found
+
+# Largest even tile side up to n that OpenCV phase correlates without padding.  Odd sizes, padded or not, bias
+# the peak by half a pixel
+def dft_size(n):
+    while n % 2 or cv2.getOptimalDFTSize(n) != n:
+        n -= 1
+    return n
+
+# Error in LR pixels of a tps render, from phase correlating tiles of it against the exact warp
+def render_error(folder, base, truth):
+    rendered = cv2.imread(os.path.join(folder, 'Output', 'HR', base+'.png'), cv2.IMREAD_GRAYSCALE)
+    if rendered is None:
+        return None
+    highres = cv2.imread(os.path.join(folder, 'HR', base+'.png'), cv2.IMREAD_GRAYSCALE)
+    height, width = rendered.shape
+    xs, ys = np.meshgrid(np.arange(width, dtype=np.float64)/scale, np.arange(height, dtype=np.float64)/scale)
+    mapx, mapy = tps_source(np.array(truth['truth']), [(np.array(a), fx, fy, p) for a, fx, fy, p in truth['waves']], xs, ys)
+    exact = cv2.remap(highres, mapx.astype(np.float32), mapy.astype(np.float32), cv2.INTER_LINEAR)
+
+    tiley, tilex = dft_size(height//CHECK_TILES), dft_size(width//CHECK_TILES)
+    window = cv2.createHanningWindow((tilex, tiley), cv2.CV_32F)
+    errors = []
+    for y0 in range(0, tiley*CHECK_TILES, tiley):
+        for x0 in range(0, tilex*CHECK_TILES, tilex):
+            (dx, dy), _ = cv2.phaseCorrelate(exact[y0:y0+tiley,x0:x0+tilex].astype(np.float32), rendered[y0:y0+tiley,x0:x0+tilex].astype(np.float32), window)
+            errors.append(np.hypot(dx, dy)/scale)
+    return float(np.sqrt(np.mean(np.square(errors)))), float(np.max(errors))
+
+# Misalignment in LR pixels of the rendered output pair, from phase correlating tiles of the LR output against
+# the HR output reduced to its size.  Catches errors in rendering as well as in the found transform
+def output_error(folder, base):
+    highres = cv2.imread(os.path.join(folder, 'Output', 'HR', base+'.png'), cv2.IMREAD_GRAYSCALE)
+    lowres = cv2.imread(os.path.join(folder, 'Output', 'LR', base+'.png'), cv2.IMREAD_GRAYSCALE)
+    if highres is None or lowres is None:
+        return None
+    height, width = lowres.shape
+    reduced = cv2.resize(highres, (width, height), interpolation=cv2.INTER_AREA)
+
+    tiley, tilex = dft_size(height//CHECK_TILES), dft_size(width//CHECK_TILES)
+    window = cv2.createHanningWindow((tilex, tiley), cv2.CV_32F)
+    errors = []
+    for y0 in range(0, tiley*CHECK_TILES, tiley):
+        for x0 in range(0, tilex*CHECK_TILES, tilex):
+            (dx, dy), _ = cv2.phaseCorrelate(reduced[y0:y0+tiley,x0:x0+tilex].astype(np.float32), lowres[y0:y0+tiley,x0:x0+tilex].astype(np.float32), window)
+            errors.append(np.hypot(dx, dy))
+    return float(np.sqrt(np.mean(np.square(errors)))), float(np.max(errors))
+
+# ImgAlign settings of each case, and the cases that align the pairs of another case
+CASE_FLAGS = {'scale': [], 'sift': ['--phase'], 'rotate': ['-r'], 'perspective': ['-f'], 'autocrop': ['-c'], 'tps': []}
+CASE_PAIRS = {'sift': 'scale'}
+
+# Generate, align and measure one case.  Each kind of pair has its own random stream, so a case gets the
+# same pairs whichever other cases run
+def run_case(case):
+    folder = os.path.join(args["out"], case)
+    shutil.rmtree(folder, ignore_errors=True)
+    kind = CASE_PAIRS.get(case, case)
+    rng = np.random.default_rng([int(args["seed"]), sorted(CASE_FLAGS).index(kind)])
+    truths = generate(kind, folder, rng)
+
+    command = [sys.executable, args["script"], '-s', str(scale), '-m', '0', '-g', 'HR', '-l', 'LR', '-n', str(args["threads"]), '--profile', 'profile.jsonl'] + CASE_FLAGS[case]
+    command += ['--apply', 'Apply'] if case == 'tps' else ['--export']
+    start = time.perf_counter()
+    run = subprocess.run(command, cwd=folder, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    elapsed = time.perf_counter() - start
+    with open(os.path.join(folder, 'log.txt'), 'w') as f:
+        f.write(run.stdout)
+
+    times, peaks = [], []
+    if os.path.exists(os.path.join(folder, 'profile.jsonl')):
+        with open(os.path.join(folder, 'profile.jsonl')) as f:
+            for line in f:
+                record = json.loads(line)
+                times.append(sum(entry['time'] for entry in record['stages'].values()))
+                if record.get('peak') is not None:
+                    peaks.append(record['peak'])
+
+    errors, outputs = [], []
+    for base, truth in truths.items():
+        if case == 'tps':
+            error = render_error(folder, base, truth)
+        else:
+            sidecar = os.path.join(folder, 'Output', 'Transforms', base+'.json')
+            error = None
+            if os.path.exists(sidecar):
+                with open(sidecar) as f:
+                    record = json.load(f)
+                error = transform_error(found_transform(record, truth), renderer_truth(np.array(truth['truth'])), truth['lrsize'])
+        if error is not None:
+            errors.append(error)
+        output = output_error(folder, base)
+        if output is not None:
+            outputs.append(output)
+
+    return {'pairs': len(truths), 'failed': len(truths) - len(errors), 'seconds': round(elapsed, 3), 'pairs_per_s': round(len(truths)/elapsed, 3),
+            'p50': round(float(np.percentile(times, 50)), 4) if times else None, 'p95': round(float(np.percentile(times, 95)), 4) if times else None,
+            'peak_mb': round(max(peaks)) if peaks else None,
+            'rms_error': round(float(np.sqrt(np.mean([e[0]**2 for e in errors]))), 4) if errors else None,
+            'max_error': round(max(e[1] for e in errors), 4) if errors else None,
+            'output_rms': round(float(np.sqrt(np.mean([e[0]**2 for e in outputs]))), 4) if outputs else None,
+            'output_max': round(max(e[1] for e in outputs), 4) if outputs else None}
+
+# Table of the results, with the change against a baseline run when there is one
+def report(results, baseline):
+    columns = ('pairs', 'failed', 'pairs_per_s', 'p50', 'p95', 'peak_mb', 'rms_error', 'max_error', 'output_rms', 'output_max')
+    print('{:<12s}'.format('Case') + ''.join('{:>12s}'.format(column) for column in columns))
+    for case, result in results.items():
+        print('{:<12s}'.format(case) + ''.join('{:>12s}'.format('-' if result[column] is None else str(result[column])) for column in columns))
+        old = baseline.get(case)
+        if old:
+            change = lambda column: '-' if result[column] is None or not old.get(column) else '{:+.1f}%'.format(100*(result[column]/old[column] - 1))
+            print('{:<12s}'.format('  vs base') + ''.join('{:>12s}'.format(change(column) if column in columns[2:] else '') for column in columns))
+
+if __name__ == '__main__':
+    os.makedirs(args["out"], exist_ok=True)
+    baseline = {}
+    if args["baseline"]:
+        with open(args["baseline"]) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for case in args["cases"].split(','):
+        print('Running', case)
+        results[case] = run_case(case)
+
+    with open(os.path.join(args["out"], 'results.json'), 'w') as f:
+        json.dump(results, f, indent=1)
+    report(results, baseline)